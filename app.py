@@ -1,18 +1,164 @@
-from flask import Flask, request, render_template, jsonify, Response
-import os, sys
+from flask import (Flask, request, render_template, jsonify, Response, 
+        stream_with_context)
+import os, sys, time, gzip, math, json, base64, threading, hashlib
 import urllib.parse
+import requests
+from concurrent.futures import ThreadPoolExecutor, Future
 import numpy as np
 from dotenv import load_dotenv
 from elevation_data import *
+from elevation_cache import *
 from map_data import *
 from pathfinder import *
+from metrics import *
+from payload import pack_result, encode_times
+from ttl_cache import TTLCache
+from graph_store import GraphStore
+from search_executor import SearchExecutor, SearchQueueFull, SearchTimeout
 
 load_dotenv() # load variables stored in .env file 
 
 app = Flask(__name__)
 
+# elevation tiles are cached on disk and shared by all remote elevation sources
+cache_dir = os.getenv('HYKR_CACHE_DIR', '.cache')
+elev_tile_cache = DiskCache(os.path.join(cache_dir, 'elevation'), 
+        int(os.getenv('HYKR_ELEV_CACHE_MB', '1024')) * 2**20)
+land_mask_cache = LandMaskCache(DiskCache(os.path.join(cache_dir, 'land_mask'),
+        int(os.getenv('HYKR_LAND_MASK_CACHE_MB', '64')) * 2**20))
+
+# decide whether grid points are on land by a majority vote of the water 
+# image pixels in their cells, rather than by the pixel at each grid point
+land_majority = os.getenv('HYKR_LAND_MAJORITY', '0') == '1'
+
+# satellite images served by /sat_img, cached on disk and fetched over 
+# pooled keep-alive connections
+sat_img_cache = DiskCache(os.path.join(cache_dir, 'sat_img'), 
+        int(os.getenv('HYKR_SAT_IMG_CACHE_MB', '512')) * 2**20)
+sat_img_max_age = int(os.getenv('HYKR_SAT_IMG_MAX_AGE', '86400'))
+sat_img_session = requests.Session()
+sat_img_adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=int(os.getenv('HYKR_SAT_IMG_CONNECTIONS', '16')))
+sat_img_session.mount('http://', sat_img_adapter)
+sat_img_session.mount('https://', sat_img_adapter)
+
+# directory of SRTM .hgt files for the local_dem elevation source
+dem_dir = os.getenv('DEM_DIR', 'dem')
+
+# elevation and map servers by source, made on first use and shared by all 
+# requests, so their connections and memoized metadata are reused
+elev_servers = {}
+map_servers = {}
+providers_lock = threading.Lock()
+
+# graphs of regions built with build_region.py, searched instead of computing
+# the graph of each route inside them
+graph_store = GraphStore(DiskCache(os.path.join(cache_dir, 'region_graph'),
+        int(os.getenv('HYKR_REGION_GRAPH_CACHE_MB', '4096')) * 2**20))
+
+# finished routes, reused by requests between the same grid points
+result_cache = TTLCache(int(os.getenv('HYKR_RESULT_CACHE_SIZE', '256')),
+        float(os.getenv('HYKR_RESULT_CACHE_TTL', '3600')))
+
+# travel time fields from isochrone requests, which also answer later routes
+# from the same start point
+travel_time_fields = TTLCache(int(os.getenv('HYKR_ISOCHRONE_CACHE_SIZE', '16')),
+        float(os.getenv('HYKR_RESULT_CACHE_TTL', '3600')))
+max_isochrone_hours = float(os.getenv('HYKR_MAX_ISOCHRONE_HOURS', '12'))
+
+# most legs in one /calculate_batch request
+max_batch_legs = int(os.getenv('HYKR_MAX_BATCH_LEGS', '100'))
+
+# seconds between snapshots of the search sent by /calculate_result_stream
+snapshot_interval = float(os.getenv('HYKR_SNAPSHOT_INTERVAL', '0.25'))
+
+# threads used to fetch the independent data for each route at the same time
+fetch_pool = ThreadPoolExecutor(int(os.getenv('HYKR_FETCH_THREADS', '16')))
+
+# processes that build the graph and search it for every route, so searches
+# don't hold up the web server (one per core by default)
+search_executor = SearchExecutor(
+        int(os.getenv('HYKR_SEARCH_PROCESSES', '0')) or None, 
+        int(os.getenv('HYKR_SEARCH_QUEUE_SIZE', '16')),
+        float(os.getenv('HYKR_SEARCH_TIMEOUT', '60')))
+
 @app.route('/calculate_result')
 def calculate_result():
+    start_time = time.perf_counter()
+
+    # grab the input parameters
+    lat_start = float(request.args.get('lat_start'))
+    long_start = float(request.args.get('long_start'))
+    lat_end = float(request.args.get('lat_end'))
+    long_end = float(request.args.get('long_end'))
+    elev_source = request.args.get('elev_source')
+    map_source = request.args.get('map_source')
+    algo = request.args.get('algo')
+    timings = StageTimings()
+
+    # set up the elevation and map servers and the pathfinder
+    nx = 100
+    ny = 100
+    buff_mult = 1.2
+    elev_server = get_elev_server(elev_source)
+    map_server = get_map_server(map_source)
+    pathfinder = get_pathfinder(algo, elev_server, timings)
+    lat_long_bbox = elev_server.get_square_bbox(lat_start, long_start, lat_end, 
+                    long_end, buff_mult)
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    lat_dist, long_dist = elev_server.get_lat_long_dist(lat_min, long_min, 
+            lat_max, long_max)
+
+    # reuse the result of an earlier request between the same grid points
+    result_key = get_result_key(lat_start, long_start, lat_end, long_end, 
+            lat_long_bbox, nx, ny, elev_source, map_source, algo)
+    response = result_cache.get(result_key)
+    metrics.inc('cache_requests_total', cache='route_result', 
+            result='miss' if response is None else 'hit')
+    if response is not None:
+        return send_result(dict(response), timings, start_time)
+
+    # or read the path from a travel time field computed from the same start
+    response = get_field_route(lat_start, long_start, lat_end, long_end, 
+            elev_source, map_source)
+    metrics.inc('cache_requests_total', cache='travel_time_field', 
+            result='miss' if response is None else 'hit')
+    if response is not None:
+        return send_result(response, timings, start_time)
+
+    # start fetching the elevation data, image metadata and water mask at once
+    graph_name = get_graph_name(elev_source, map_source)
+    elev_future, metadata_future, land_future = fetch_grid_data(elev_server, 
+            map_server, pathfinder, lat_long_bbox, nx, ny, timings, graph_name)
+
+    # find the optimal path as soon as the elevations and water mask arrive
+    elev = elev_future.result()
+    elev2d = np.reshape(np.array(elev), (ny, nx)).T # indexed [i, j]
+    result, path = search_executor.run('get_optimal_path', pathfinder, 
+            (lat_start, long_start, lat_end, long_end, lat_long_bbox, 
+                lat_dist, long_dist, nx, ny), elev2d, land_future.result(), 
+            graph_name=graph_name)
+    metrics.inc('nodes_settled_total', pathfinder.num_visited, algo=algo)
+    metrics.inc('heap_pushes_total', pathfinder.num_pushes, algo=algo)
+    metrics.inc('heap_decrease_keys_total', pathfinder.num_decrease_keys, 
+            algo=algo)
+
+    response = get_terrain_response(elev_server, map_server, map_source, 
+            lat_long_bbox, lat_dist, long_dist, nx, ny, elev, 
+            metadata_future.result())
+    response.update({"result":result, "path":path, 
+        "num_visited":pathfinder.num_visited})
+    result_cache.put(result_key, response)
+    return send_result(dict(response), timings, start_time)
+
+@app.route('/calculate_result_stream')
+def calculate_result_stream():
+    '''Stream a route result as server-sent events: a terrain event as soon 
+    as the elevations arrive, frontier events with the grid points reached 
+    so far while searching, and then a result event with the path, or an 
+    error event if the route can't be found'''
+    start_time = time.perf_counter()
+
     # grab the input parameters
     lat_start = float(request.args.get('lat_start'))
     long_start = float(request.args.get('long_start'))
@@ -21,30 +167,328 @@ def calculate_result():
     elev_source = request.args.get('elev_source')
     map_source = request.args.get('map_source')
     algo = request.args.get('algo')
+    timings = StageTimings()
 
-    # get the elevation data
+    # set up the elevation and map servers and the pathfinder
     nx = 100
     ny = 100
     buff_mult = 1.2
+    elev_server = get_elev_server(elev_source)
+    map_server = get_map_server(map_source)
+    pathfinder = get_pathfinder(algo, elev_server, timings)
+    lat_long_bbox = elev_server.get_square_bbox(lat_start, long_start, lat_end, 
+                    long_end, buff_mult)
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    lat_dist, long_dist = elev_server.get_lat_long_dist(lat_min, long_min, 
+            lat_max, long_max)
+    metrics.inc('requests_total', endpoint='calculate_result_stream')
+
+    # send a finished route straight away
+    result_key = get_result_key(lat_start, long_start, lat_end, long_end, 
+            lat_long_bbox, nx, ny, elev_source, map_source, algo)
+    response = result_cache.get(result_key)
+    if response is None:
+        response = get_field_route(lat_start, long_start, lat_end, long_end, 
+                elev_source, map_source)
+    if response is not None:
+        result_fields = ("result", "path", "num_visited")
+        events = [terrain_event({k:v for k,v in response.items() 
+            if k not in result_fields}), format_event('result', 
+                {k:response[k] for k in result_fields})]
+        return event_stream_response(iter(events))
+
+    graph_name = get_graph_name(elev_source, map_source)
+    elev_future, metadata_future, land_future = fetch_grid_data(elev_server, 
+            map_server, pathfinder, lat_long_bbox, nx, ny, timings, graph_name)
+
+    def events():
+        try:
+            yield from route_events()
+        except Exception as e:
+            app.logger.exception('route stream failed')
+            yield format_event('error', {"error":str(e)})
+
+    def route_events():
+        elev = elev_future.result()
+        elev2d = np.reshape(np.array(elev), (ny, nx)).T # indexed [i, j]
+        response = get_terrain_response(elev_server, map_server, map_source, 
+                lat_long_bbox, lat_dist, long_dist, nx, ny, elev, 
+                metadata_future.result())
+        yield terrain_event(response)
+
+        # search in a worker process, which shares snapshots of the grid 
+        # points reached, and stop it if the client goes away
+        job = search_executor.submit('get_optimal_path', pathfinder, 
+                (lat_start, long_start, lat_end, long_end, lat_long_bbox, 
+                    lat_dist, long_dist, nx, ny), elev2d, land_future.result(),
+                snapshot_interval=snapshot_interval, graph_name=graph_name)
+        try:
+            while not job.done():
+                time.sleep(snapshot_interval)
+                reached = job.snapshot()
+                if reached is None:
+                    continue
+                # ordered like the elevations, i.e. by grid index j then i
+                bits = np.packbits(reached.reshape(nx, ny).T)
+                yield format_event('frontier', {"reached":
+                    base64.b64encode(bits.tobytes()).decode('ascii')})
+            result, path = job.result()
+        finally:
+            job.cancel()
+        metrics.inc('nodes_settled_total', pathfinder.num_visited, algo=algo)
+
+        response.update({"result":result, "path":path, 
+            "num_visited":pathfinder.num_visited})
+        result_cache.put(result_key, response)
+        timings.timings['total'] = time.perf_counter() - start_time
+        yield format_event('result', {"result":result, "path":path, 
+            "num_visited":pathfinder.num_visited, "timings":timings.timings})
+
+    return event_stream_response(stream_with_context(events()))
+
+@app.errorhandler(SearchQueueFull)
+def search_queue_full(e):
+    return jsonify({"error":str(e)}), 503
+
+@app.errorhandler(SearchTimeout)
+def search_timeout(e):
+    return jsonify({"error":str(e)}), 504
+
+def terrain_event(response):
+    '''Format the terrain fields of a response as a terrain event, with the 
+    elevations packed like a binary result (see payload.py) in base64'''
+    header = {k:v for k,v in response.items() if k != "elev"}
+    payload = pack_result(header, response["elev"], [], response["nx"], 
+            response["ny"])
+    return format_event('terrain', 
+            {"payload":base64.b64encode(payload).decode('ascii')})
+
+def format_event(name, data):
+    '''Format a server-sent event with JSON data'''
+    return 'event: ' + name + '\ndata: ' + json.dumps(data) + '\n\n'
+
+def event_stream_response(events):
+    '''Send server-sent events as they are generated, without buffering'''
+    return Response(events, mimetype='text/event-stream', 
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/calculate_isochrone')
+def calculate_isochrone():
+    '''Find the travel time from a start point to every grid point that can 
+    be reached within a number of hours'''
+    start_time = time.perf_counter()
+
+    # grab the input parameters
+    lat_start = float(request.args.get('lat_start'))
+    long_start = float(request.args.get('long_start'))
+    hours = min(float(request.args.get('hours', '1')), max_isochrone_hours)
+    elev_source = request.args.get('elev_source')
+    map_source = request.args.get('map_source')
+    timings = StageTimings()
+    if not hours > 0.0:
+        return jsonify({"error":"hours must be greater than 0"}), 400
+
+    # set up the elevation and map servers and the pathfinder, on a grid that
+    # reaches as far as can be walked in time at the maximum walking speed
+    nx = 100
+    ny = 100
+    max_time = 3600.0*hours
+    elev_server = get_elev_server(elev_source)
+    map_server = get_map_server(map_source)
+    pathfinder = Dijkstra(land_mask_cache, timings, 
+            land_majority=land_majority)
+    lat_long_bbox = elev_server.get_radius_bbox(lat_start, long_start, 
+            PathFinder.max_speed*max_time)
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    lat_dist, long_dist = elev_server.get_lat_long_dist(lat_min, long_min, 
+            lat_max, long_max)
+
+    # reuse the field of an earlier request from the same grid point
+    field_key = get_result_key(lat_start, long_start, lat_start, long_start, 
+            lat_long_bbox, nx, ny, elev_source, map_source)
+    field = travel_time_fields.get(field_key)
+    metrics.inc('cache_requests_total', cache='isochrone', 
+            result='miss' if field is None else 'hit')
+    if field is not None:
+        return send_result(dict(field["response"]), timings, start_time,
+                'calculate_isochrone')
+
+    elev_future, metadata_future, land_future = fetch_grid_data(elev_server, 
+            map_server, pathfinder, lat_long_bbox, nx, ny, timings)
+    elev = elev_future.result()
+    elev2d = np.reshape(np.array(elev), (ny, nx)).T # indexed [i, j]
+    result, times, parents = search_executor.run('get_travel_times', 
+            pathfinder, (lat_start, long_start, lat_long_bbox, lat_dist, 
+                long_dist, nx, ny), elev2d, land_future.result(), 
+            max_time=max_time)
+    metrics.inc('nodes_settled_total', pathfinder.num_visited, 
+            algo='isochrone')
+
+    response = get_terrain_response(elev_server, map_server, map_source, 
+            lat_long_bbox, lat_dist, long_dist, nx, ny, elev, 
+            metadata_future.result())
+    response.update({"result":result, "max_time":max_time, 
+        "num_visited":pathfinder.num_visited})
+    if result == PathFinderResult.OK:
+        # times are ordered like the elevations, i.e. by grid index j then i
+        response["times"], response["time_scale"] = encode_times(
+                times.T.ravel(), max_time)
+        travel_time_fields.put(field_key, {"lat_long_bbox":lat_long_bbox, 
+            "sources":(elev_source, map_source), 
+            "start":PathFinder.get_grid_indices(lat_start, long_start, 
+                lat_long_bbox, nx, ny), "times":times.ravel(), 
+            "parents":parents, "response":response})
+    return send_result(dict(response), timings, start_time, 
+            'calculate_isochrone')
+
+@app.route('/calculate_batch', methods=['POST'])
+def calculate_batch():
+    '''Find the routes of many legs over one grid, posted as JSON with 
+    "legs", a list of [lat_start, long_start, lat_end, long_end], the 
+    sources and algo, and optionally "bbox", [lat_min, long_min, lat_max, 
+    long_max], which otherwise covers all the legs'''
+    start_time = time.perf_counter()
+
+    # grab the input parameters
+    params = request.get_json(force=True)
+    legs = [tuple(float(v) for v in leg) for leg in params.get('legs', [])]
+    if len(legs) == 0 or len(legs) > max_batch_legs:
+        return jsonify({"error":"a batch needs 1 to " + str(max_batch_legs) + 
+            " legs"}), 400
+    elev_source = params.get('elev_source')
+    map_source = params.get('map_source')
+    algo = params.get('algo')
+    timings = StageTimings()
+
+    # set up the elevation and map servers and the pathfinder
+    nx = 100
+    ny = 100
+    buff_mult = 1.2
+    elev_server = get_elev_server(elev_source)
+    map_server = get_map_server(map_source)
+    pathfinder = get_pathfinder(algo, elev_server, timings)
+    if params.get('bbox') is not None:
+        lat_long_bbox = tuple(float(v) for v in params['bbox'])
+    else:
+        lats = [leg[k] for leg in legs for k in (0, 2)]
+        longs = [leg[k] for leg in legs for k in (1, 3)]
+        lat_long_bbox = elev_server.get_square_bbox(min(lats), min(longs), 
+                max(lats), max(longs), buff_mult)
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    lat_dist, long_dist = elev_server.get_lat_long_dist(lat_min, long_min, 
+            lat_max, long_max)
+
+    # fetch the grid data and build the graph once for all the legs
+    graph_name = get_graph_name(elev_source, map_source)
+    elev_future, metadata_future, land_future = fetch_grid_data(elev_server, 
+            map_server, pathfinder, lat_long_bbox, nx, ny, timings, graph_name)
+    elev = elev_future.result()
+    elev2d = np.reshape(np.array(elev), (ny, nx)).T # indexed [i, j]
+    results = search_executor.run('get_optimal_paths', pathfinder, (legs, 
+        lat_long_bbox, lat_dist, long_dist, nx, ny), elev2d, 
+        land_future.result(), graph_name=graph_name)
+    metrics.inc('nodes_settled_total', pathfinder.num_visited, algo=algo)
+    metrics.inc('heap_pushes_total', pathfinder.num_pushes, algo=algo)
+    metrics.inc('heap_decrease_keys_total', pathfinder.num_decrease_keys, 
+            algo=algo)
+
+    response = get_terrain_response(elev_server, map_server, map_source, 
+            lat_long_bbox, lat_dist, long_dist, nx, ny, elev, 
+            metadata_future.result())
+    response.update({"legs":[{"result":result, "path":path} 
+        for result, path in results], "num_visited":pathfinder.num_visited})
+    return send_result(response, timings, start_time, 'calculate_batch')
+
+def get_pathfinder(algo, elev_server, timings):
+    if algo == 'bidir_dijkstra':
+        pathfinder = BidirectionalDijkstra(land_mask_cache, timings, 
+                graph_store, land_majority)
+    elif algo == 'a_star':
+        pathfinder = AStar(land_mask_cache, timings, graph_store, 
+                land_majority)
+    elif algo == 'multires_dijkstra':
+        pathfinder = MultiResolutionDijkstra(land_mask_cache, timings, 
+                elev_server, land_majority=land_majority)
+    else:
+        pathfinder = Dijkstra(land_mask_cache, timings, graph_store, 
+                land_majority)
+    return pathfinder
+
+def get_graph_name(elev_source, map_source):
+    '''Get the name region graphs built from a pair of sources are stored 
+    under'''
+    return elev_source + '-' + map_source
+
+def get_elev_server(elev_source):
+    '''Get the long-lived elevation server for a source'''
+    with providers_lock:
+        elev_server = elev_servers.get(elev_source)
+        if elev_server is None:
+            elev_server = make_elev_server(elev_source)
+            elev_servers[elev_source] = elev_server
+    return elev_server
+
+def make_elev_server(elev_source):
+    '''Make the elevation server for a source, with the tiles of remote 
+    sources cached'''
+    if elev_source == 'local_dem':
+        return DEMData(dem_dir)
     if elev_source == 'open_topo_data':
         elev_server = OpenTopoData()
     elif elev_source == 'epqs':
         elev_server = EPQSData()
     elif elev_source == 'bing_maps':
         elev_server = BingElevData()
-    lat_long_bbox = elev_server.get_square_bbox(lat_start, long_start, lat_end, 
-                    long_end, buff_mult)
-    lat_min, long_min, lat_max, long_max = lat_long_bbox
-    lat_dist, long_dist = elev_server.get_lat_long_dist(lat_min, long_min, 
-            lat_max, long_max)
-    elev = elev_server.get_elevations(lat_long_bbox, nx, ny)
+    return CachedElevationData(elev_server, elev_tile_cache)
 
-    # get the image data
+def get_map_server(map_source):
+    '''Get the long-lived map server for a source'''
+    with providers_lock:
+        map_server = map_servers.get(map_source)
+        if map_server is None:
+            map_server = make_map_server(map_source)
+            map_servers[map_source] = map_server
+    return map_server
+
+def make_map_server(map_source):
     if map_source == 'bing_maps':
         map_server = BingMapData()
+    return map_server
+
+def fetch_grid_data(elev_server, map_server, pathfinder, lat_long_bbox, 
+        nx, ny, timings, graph_name=None):
+    '''Start fetching the elevations, image metadata and land grid for a 
+    bbox at once, returning a future for each
+
+    If graph_name is given and a region stored under it covers the bbox, 
+    the search only needs that region's graph, so the land grid is taken 
+    from the region instead of the water image.
+    '''
+    res = (1000,1000)
+    elev_future = fetch_pool.submit(timings.timed, 'elevation_fetch', 
+            elev_server.get_elevations, lat_long_bbox, nx, ny)
+    metadata_future = fetch_pool.submit(timings.timed, 'image_metadata', 
+            map_server.get_image_metadata, lat_long_bbox, res)
+    region = None
+    if graph_name is not None and pathfinder.graph_store is not None:
+        region = pathfinder.graph_store.get(graph_name, lat_long_bbox, nx, ny)
+    if region is not None:
+        land_future = Future()
+        land_future.set_result(pathfinder.get_region_land_grid(region, 
+            lat_long_bbox, nx, ny))
+    else:
+        land_future = fetch_pool.submit(timings.timed, 'land_grid', 
+                pathfinder.get_land_grid, lat_long_bbox, nx, ny, map_server)
+    return elev_future, metadata_future, land_future
+
+def get_terrain_response(elev_server, map_server, map_source, lat_long_bbox, 
+        lat_dist, long_dist, nx, ny, elev, metadata):
+    '''Form the terrain and satellite image fields of a response'''
+    # get the image data
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
     res = (1000,1000)
     sat_img_base_url = map_server.get_satellite_image_url(lat_long_bbox, res)
-    bbox, yres, xres = map_server.get_image_metadata(lat_long_bbox, res) 
+    bbox, yres, xres = metadata
     map_lat_dist, map_long_dist = elev_server.get_lat_long_dist(bbox[0], 
             bbox[1], bbox[2], bbox[3])
     tex_scale_x = long_dist / map_long_dist
@@ -58,17 +502,75 @@ def calculate_result():
     sat_img_proxy_url = request.host_url + 'sat_img/' + map_source + \
             '/' + urllib.parse.quote(sat_img_base_url)
 
-    # find the optimal path
-    # TODO
-    pathfinder = Dijkstra()
-    elev2d = np.reshape(np.array(elev), (nx, ny))
-    result, path = pathfinder.get_optimal_path(lat_start, long_start, lat_end, long_end, 
-            lat_long_bbox, lat_dist, long_dist, nx, ny, elev2d, map_server)
-
-    return jsonify({"elev":elev, "image_url":sat_img_proxy_url, "nx":nx, "ny":ny, 
+    return {"elev":elev, "image_url":sat_img_proxy_url, "nx":nx, "ny":ny, 
         "lat_dist":lat_dist, "long_dist":long_dist, "tex_scale_x":tex_scale_x,
         "tex_scale_y":tex_scale_y, "tex_shift_x":tex_shift_x, 
-        "tex_shift_y":tex_shift_y, "result":result, "path":path})
+        "tex_shift_y":tex_shift_y}
+
+def get_field_route(lat_start, long_start, lat_end, long_end, *sources):
+    '''Get a route response from a stored travel time field which starts at 
+    the same grid point and reaches the end point, or None if there isn't one'''
+    for field in travel_time_fields.values():
+        response = field["response"]
+        nx, ny = response["nx"], response["ny"]
+        lat_long_bbox = field["lat_long_bbox"]
+        if field["sources"] != sources:
+            continue
+        start = PathFinder.get_grid_indices(lat_start, long_start, 
+                lat_long_bbox, nx, ny)
+        ei, ej = PathFinder.get_grid_indices(lat_end, long_end, lat_long_bbox,
+                nx, ny)
+        if start != field["start"] or not (0 <= ei < nx and 0 <= ej < ny):
+            continue
+        target = ei*ny + ej
+        if np.isinf(field["times"][target]):
+            continue
+        source = start[0]*ny + start[1]
+        path = PathFinder.trace_path(field["parents"], source, target, ny)
+        terrain = {k:v for k,v in response.items() 
+                if k not in ("times", "time_scale", "max_time")}
+        return dict(terrain, result=PathFinderResult.OK, path=path, 
+                num_visited=0)
+    return None
+
+def get_result_key(lat_start, long_start, lat_end, long_end, lat_long_bbox, 
+        nx, ny, *sources):
+    '''Get the result cache key for a route, with the bbox quantized to about
+    a quarter of a grid cell and the start/end points snapped to grid points'''
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    quantum = 2.0**math.floor(math.log2((lat_max - lat_min) / ny / 4))
+    bbox = tuple(round(v / quantum) for v in lat_long_bbox)
+    start = PathFinder.get_grid_indices(lat_start, long_start, lat_long_bbox, 
+            nx, ny)
+    end = PathFinder.get_grid_indices(lat_end, long_end, lat_long_bbox, nx, ny)
+    return (quantum, bbox, nx, ny, start, end) + sources
+
+def send_result(response, timings, start_time, endpoint='calculate_result'):
+    '''Send a route result as JSON, or in binary if requested, with its 
+    timings if requested'''
+    metrics.inc('requests_total', endpoint=endpoint)
+    timings.timings['total'] = time.perf_counter() - start_time
+    if request.args.get('timings'):
+        response["timings"] = timings.timings
+    if request.args.get('format') == 'binary' and "path" in response:
+        return binary_response(response)
+    return jsonify(response)
+
+def binary_response(response):
+    '''Send a route result as a gzipped binary payload, see payload.py'''
+    header = {k:v for k,v in response.items() if k not in ("elev", "path")}
+    body = pack_result(header, response["elev"], response["path"], 
+            response["nx"], response["ny"])
+    resp = Response(body, mimetype='application/octet-stream')
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resp.set_data(gzip.compress(body, 6))
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+@app.route('/metrics')
+def metrics_text():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route("/")
 def index():
@@ -76,17 +578,67 @@ def index():
 
 @app.route('/sat_img/<path:map_source_and_url>', methods=['GET'])
 def sat_img_proxy(map_source_and_url):
+    '''Stream a satellite image from the map server, adding the API key, or
+    from the disk cache, where images are keyed by their url without the 
+    key'''
     # split route into map_source and image url 
     [map_source, sat_img_base_url] = map_source_and_url.split('/',1)
 
-    # determine which map server to use
-    if (map_source == 'bing_maps'):
-        map_server = BingMapData()
+    # the image at a url doesn't change, so its hash serves as the ETag
+    name = hashlib.sha1(map_source_and_url.encode('utf-8')).hexdigest()
+    headers = {'ETag': '"' + name + '"', 
+            'Cache-Control': 'public, max-age=' + str(sat_img_max_age)}
+    if request.if_none_match.contains(name):
+        metrics.inc('cache_requests_total', cache='sat_img', 
+                result='not_modified')
+        return Response(status=304, headers=headers)
+
+    path = sat_img_cache.get_path(name)
+    metrics.inc('cache_requests_total', cache='sat_img', 
+            result='miss' if path is None else 'hit')
+    if path is not None:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError: # evicted since get_path
+            path = None
+    if path is not None:
+        mimetype = f.readline().decode('ascii').strip()
+        headers['Content-Length'] = str(os.path.getsize(path) - f.tell())
+        return Response(read_chunks(f), mimetype=mimetype, headers=headers)
+
+    # otherwise stream the image from the map server, caching it once it 
+    # has all been sent
+    map_server = get_map_server(map_source)
     sat_img_url = sat_img_base_url + map_server.get_api_key()
-    if request.method=='GET':
-        resp = requests.get(sat_img_url)
-        response = Response(resp.content, resp.status_code)
-    return response
+    resp = sat_img_session.get(sat_img_url, stream=True, timeout=30)
+    if resp.status_code != 200:
+        # read the error before closing, which drops the unread body
+        content, content_type = resp.content, resp.headers.get('Content-Type')
+        resp.close()
+        return Response(content, resp.status_code, content_type=content_type)
+    mimetype = resp.headers.get('Content-Type', 'image/jpeg')
+    if 'Content-Length' in resp.headers:
+        headers['Content-Length'] = resp.headers['Content-Length']
+
+    def chunks():
+        body = []
+        try:
+            for chunk in resp.iter_content(65536):
+                body.append(chunk)
+                yield chunk
+        finally:
+            resp.close()
+        metrics.inc('fetched_bytes_total', sum(len(c) for c in body), 
+                source=type(map_server).__name__)
+        sat_img_cache.put(name, lambda f: f.writelines(
+            [mimetype.encode('ascii') + b'\n'] + body))
+    return Response(chunks(), mimetype=mimetype, headers=headers)
+
+def read_chunks(f, chunk_size=65536):
+    '''Yield the rest of an open file in chunks, and then close it'''
+    with f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
 
 if __name__ == "__main__":
     app.run("127.0.0.1", port=5000, debug=True)
@@ -0,0 +1,131 @@
+'''Offline benchmarks for the pathfinding hot path on synthetic terrain
+
+Runs compute_neighbor_times and each PathFinder subclass on synthetic grids,
+without any network requests, and records wall time, per-stage times, peak
+memory and search counts for each grid size as JSON, e.g.
+
+    python benchmark.py --sizes 100 500 1000 --output bench.json
+    python benchmark.py --sizes 100 500 1000 --compare bench.json
+'''
+import argparse, json, resource, subprocess, sys, time
+import numpy as np
+from scipy import interpolate
+from concurrent.futures import ProcessPoolExecutor
+from map_data import MapData
+from metrics import Metrics, StageTimings
+from pathfinder import *
+
+class StubMapData(MapData):
+    '''Map data that refuses to make network requests; the land grid is
+    passed straight to get_optimal_path instead'''
+    def get_image_metadata(self, lat_long_bbox, res):
+        raise RuntimeError('StubMapData cannot make network requests')
+
+    def get_water_image_url(self, lat_long_bbox, res):
+        raise RuntimeError('StubMapData cannot make network requests')
+
+def synthetic_terrain(n, seed=0):
+    '''Build an n x n elevation grid (m) with ridges, a valley and noise, and
+    a land grid with a few lakes'''
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0.0, 1.0, n)
+    X, Y = np.meshgrid(x, x, indexing='ij')
+
+    # ridges running diagonally across a valley, plus smoothed noise
+    elev = 400.0*np.sin(3.0*np.pi*(X + 0.5*Y))**2 + 300.0*(2.0*X - 1.0)**2
+    noise = rng.normal(0.0, 1.0, (n//10 + 2, n//10 + 2))
+    coarse = np.linspace(0.0, 1.0, noise.shape[0])
+    elev += 30.0*interpolate.RectBivariateSpline(coarse, coarse, noise)(x, x)
+
+    # lakes, keeping clear of the corners where routes start and end
+    is_land = np.ones((n, n), dtype=bool)
+    for cx, cy, r in [(0.5, 0.5, 0.08), (0.3, 0.7, 0.05), (0.7, 0.25, 0.06)]:
+        is_land &= (X - cx)**2 + (Y - cy)**2 > r**2
+    return elev, is_land
+
+def run_case(n, algo, spacing=30.0):
+    '''Find a path corner to corner on an n x n grid with the given spacing
+    (m) and return its measurements'''
+    elev2d, is_land = synthetic_terrain(n)
+    lat_dist = long_dist = n*spacing
+    dlat = lat_dist / 111045.0
+    lat_long_bbox = (44.0, -68.5, 44.0 + dlat, -68.5 + dlat)
+    lat_min, long_min, lat_max, long_max = lat_long_bbox
+    timings = StageTimings(Metrics())
+    pathfinder = get_pathfinder_classes()[algo](timings=timings)
+
+    start = time.perf_counter()
+    result, path = pathfinder.get_optimal_path(lat_min + 0.9*dlat,
+            long_min + 0.1*dlat, lat_min + 0.1*dlat, long_min + 0.9*dlat,
+            lat_long_bbox, lat_dist, long_dist, n, n, elev2d, StubMapData(),
+            is_land=is_land)
+    wall_time = time.perf_counter() - start
+
+    return {'size': n, 'algo': algo, 'result': int(result),
+            'wall_seconds': wall_time, 'stage_seconds': timings.timings,
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'num_visited': pathfinder.num_visited,
+            'num_pushes': pathfinder.num_pushes,
+            'num_decrease_keys': pathfinder.num_decrease_keys,
+            'path_length': len(path) // 2}
+
+def get_pathfinder_classes(base=PathFinder):
+    '''Get the PathFinder subclasses, including subclasses of subclasses,
+    keyed by class name'''
+    classes = {}
+    for cls in base.__subclasses__():
+        classes[cls.__name__] = cls
+        classes.update(get_pathfinder_classes(cls))
+    return classes
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+            default=[100, 250, 500, 1000, 2000])
+    parser.add_argument('--algos', nargs='+',
+            default=sorted(get_pathfinder_classes()))
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    args = parser.parse_args()
+
+    cases = []
+    for n in args.sizes:
+        for algo in args.algos:
+            # run each case in a fresh process so peak memory is its own
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                case = executor.submit(run_case, n, algo).result()
+            cases.append(case)
+            print('{:>5} {:<22} {:8.3f} s {:8.1f} MB {:>9} settled'.format(
+                n, algo, case['wall_seconds'], case['peak_rss_mb'],
+                case['num_visited']), flush=True)
+    results = {'commit': get_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0], 'numpy': np.__version__,
+            'cases': cases}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        old_cases = {(c['size'], c['algo']): c for c in old['cases']}
+        print('compared with', old['commit'])
+        for case in cases:
+            old_case = old_cases.get((case['size'], case['algo']))
+            if old_case is not None:
+                print('{:>5} {:<22} time x{:.2f} memory x{:.2f}'.format(
+                    case['size'], case['algo'],
+                    case['wall_seconds'] / old_case['wall_seconds'],
+                    case['peak_rss_mb'] / old_case['peak_rss_mb']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+'''Build the graph of a region, such as a park, for the server's graph store
+
+Routes whose bbox lies inside a stored region, at no finer a spacing than the
+region's, are then found by searching the stored graph, e.g.
+
+    python build_region.py 44.20 -68.45 44.45 -68.15 --nx 1000 --ny 1000
+'''
+import argparse, time
+import numpy as np
+from app import (graph_store, land_mask_cache, get_elev_server, get_map_server,
+        get_graph_name)
+from pathfinder import Dijkstra
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('lat_min', type=float)
+    parser.add_argument('long_min', type=float)
+    parser.add_argument('lat_max', type=float)
+    parser.add_argument('long_max', type=float)
+    parser.add_argument('--nx', type=int, default=1000)
+    parser.add_argument('--ny', type=int, default=1000)
+    parser.add_argument('--elev-source', default='bing_maps')
+    parser.add_argument('--map-source', default='bing_maps')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    elev_server = get_elev_server(args.elev_source)
+    map_server = get_map_server(args.map_source)
+    lat_long_bbox = (args.lat_min, args.long_min, args.lat_max, args.long_max)
+    lat_dist, long_dist = elev_server.get_lat_long_dist(*lat_long_bbox)
+    elev = elev_server.get_elevations(lat_long_bbox, args.nx, args.ny)
+    elev2d = np.reshape(np.array(elev), (args.ny, args.nx)).T # indexed [i, j]
+
+    pathfinder = Dijkstra(land_mask_cache, graph_store=graph_store)
+    pathfinder.build_region(get_graph_name(args.elev_source, args.map_source),
+            lat_long_bbox, lat_dist, long_dist, args.nx, args.ny, elev2d,
+            map_server)
+    print('built {} x {} region graph in {:.1f} s'.format(args.nx, args.ny,
+        time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os, threading, fcntl
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class DiskCache:
+    '''Size-bounded cache of files in a directory, which evicts the least
+    recently used files once the total size exceeds max_bytes
+
+    The directory can be shared by several processes. Files are added and
+    evicted while holding a lock file, which counts the changes made, and 
+    each process rescans the directory whenever another process has changed 
+    it, so that its index and the total size it evicts against stay in line
+    with the directory.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # files are written here first and then moved into the cache
+        self.tmp_dir = os.path.join(cache_dir, '.tmp')
+        self.lock_path = os.path.join(cache_dir, '.lock')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        self.sizes = OrderedDict() # name -> size, least recently used first
+        self.total_bytes = 0
+        self.generation = None # count of changes when last indexed
+        self.refresh()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.sizes
+
+    def names(self):
+        '''Get the names of the cached files, including those added by other
+        processes'''
+        self.refresh()
+        with self.lock:
+            return list(self.sizes)
+
+    def refresh(self, generation=None):
+        '''Index the files in the directory, least recently used first, if it
+        has changed since it was last indexed'''
+        if generation is None:
+            generation = self.read_generation()
+        with self.lock:
+            if generation == self.generation:
+                return
+            files = []
+            for f in os.scandir(self.cache_dir):
+                try:
+                    if f.is_file() and not f.name.startswith('.') and \
+                            not f.name.endswith('.tmp'):
+                        files.append((f.stat().st_mtime, f.name,
+                            f.stat().st_size))
+                except FileNotFoundError: # evicted by another process
+                    pass
+            self.sizes = OrderedDict((name, size)
+                    for _, name, size in sorted(files))
+            self.total_bytes = sum(self.sizes.values())
+            self.generation = generation
+
+    def get_path(self, name):
+        '''Get the path to a cached file and mark it as recently used, or None
+        if the file isn't cached'''
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            indexed = name in self.sizes
+            if indexed:
+                self.sizes.move_to_end(name)
+        if not indexed:
+            # it may have been added by another process
+            if not os.path.isfile(path):
+                return None
+            self.refresh()
+        try:
+            os.utime(path) # keep the recency across restarts and processes
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, name, write):
+        '''Add a file to the cache, where write(f) writes its contents to the
+        binary file object f, and evict files if the cache is too big'''
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = os.path.join(self.tmp_dir, '{}.{}.{}'.format(name,
+            os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        size = os.path.getsize(tmp_path)
+
+        with self.directory_lock() as lock_file:
+            generation = self.read_generation()
+            self.refresh(generation)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.total_bytes += size - self.sizes.pop(name, 0)
+                self.sizes[name] = size
+                while (self.total_bytes > self.max_bytes and 
+                        len(self.sizes) > 1):
+                    old_name, old_size = self.sizes.popitem(last=False)
+                    self.total_bytes -= old_size
+                    try:
+                        os.remove(os.path.join(self.cache_dir, old_name))
+                    except FileNotFoundError:
+                        pass
+                # the changes made here are already in the index
+                self.generation = generation + 1
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(str(generation + 1))
+            lock_file.flush()
+        return path
+
+    def read_generation(self):
+        '''Read the count of changes made to the directory from the lock 
+        file, or -1 if it can't be read'''
+        try:
+            with open(self.lock_path) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return -1
+
+    @contextmanager
+    def directory_lock(self):
+        '''Lock the directory against changes by other processes, yielding
+        the lock file'''
+        with open(self.lock_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
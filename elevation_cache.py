@@ -0,0 +1,153 @@
+import math
+import numpy as np
+from elevation_data import ElevationData
+from disk_cache import DiskCache
+from metrics import metrics
+
+class CachedElevationData(ElevationData):
+    '''Elevation data from another ElevationData object, cached on disk in
+    fixed tiles of a global lat/long lattice
+
+    Each tile holds tile_size x tile_size lattice points. The lattice spacing
+    in each direction is the whole number of arcseconds closest to the
+    requested grid spacing that divides the 360 degrees of longitude into
+    a whole number of tiles so that tiles line up across the antimeridian.
+    Requested grids are bilinearly interpolated from the lattice, and only
+    the lattice points around the grid that aren't cached are requested from
+    the elevation server, so tiles at the edges of a request may only be 
+    partly filled (with nan elsewhere) until a later request fills them.
+    Points that the server has no elevation for are cached as void and 
+    filled from their neighbors.
+    '''
+    tile_size = 20
+    # lattice spacings (arcseconds) that give a whole number of tiles
+    spacings = [s for s in range(1, 3601) if (360*3600) % (20*s) == 0]
+    void = -32768.0
+
+    def __init__(self, elev_server : ElevationData, disk_cache : DiskCache):
+        self.elev_server = elev_server
+        self.base_url = elev_server.base_url
+        self.api_key = elev_server.api_key
+        self.name = type(elev_server).__name__
+        self.disk_cache = disk_cache
+
+    def is_healthy(self):
+        return self.elev_server.is_healthy()
+
+    def get_spacing(self, dlat_long):
+        '''Get the lattice spacing (arcseconds) closest in ratio to the grid 
+        spacing dlat_long (degrees)'''
+        arcsec = max(dlat_long * 3600.0, self.spacings[0])
+        return min(self.spacings, key=lambda s: math.fabs(math.log(s / arcsec)))
+
+    def get_elevations(self, lat_long_bbox, nx, ny):
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        dlat = (lat_max - lat_min) / ny
+        dlong = math.fabs(long_max - long_min)
+        if dlong > 180.0:
+            dlong = 360.0 - dlong
+        dlong /= nx
+        sy = self.get_spacing(dlat)
+        sx = self.get_spacing(dlong)
+
+        # lattice coordinates of the grid points, with longitudes unwrapped
+        # past long_min so they increase across the antimeridian
+        y = (lat_max - dlat*np.arange(ny) + 90.0) * 3600.0 / sy
+        x = (long_min + dlong*np.arange(nx) + 180.0) * 3600.0 / sx
+
+        # gather the lattice points around the grid points
+        y0, y1 = int(y.min()), int(y.max()) + 1
+        x0, x1 = int(x.min()), int(x.max()) + 1
+        lattice = self.get_lattice(sy, sx, y0, y1, x0, x1)
+
+        # bilinearly interpolate the lattice onto the grid points
+        y -= y0
+        x -= x0
+        iy = np.minimum(y.astype(int), lattice.shape[0] - 2)
+        ix = np.minimum(x.astype(int), lattice.shape[1] - 2)
+        wy = (y - iy)[:,None]
+        wx = (x - ix)[None,:]
+        elev = (1.0 - wy) * ((1.0 - wx) * lattice[np.ix_(iy, ix)] +
+                wx * lattice[np.ix_(iy, ix + 1)]) + \
+                wy * ((1.0 - wx) * lattice[np.ix_(iy + 1, ix)] +
+                wx * lattice[np.ix_(iy + 1, ix + 1)])
+
+        # ordered like get_lat_long_grid, from north to south then west to east
+        return self.fill_voids(elev).ravel().tolist()
+
+    def get_lattice(self, sy, sx, y0, y1, x0, x1):
+        '''Get the lattice points y0 to y1 (south to north) by x0 to x1, from
+        the cache or else from the elevation server, with voids as nan'''
+        T = self.tile_size
+        num_tiles_x = (360*3600) // (T*sx)
+        lattice = np.full((y1 - y0 + 1, x1 - x0 + 1), np.nan, dtype='float32')
+        tiles = {} # (ty, tx) -> tile, south to north
+        for ty in range(y0 // T, y1 // T + 1):
+            for tx in range(x0 // T, x1 // T + 1):
+                path = self.disk_cache.get_path(self.tile_name(sy, sx, ty,
+                    tx % num_tiles_x))
+                metrics.inc('cache_requests_total', cache='elevation_tile', 
+                        result='miss' if path is None else 'hit')
+                if path is None:
+                    tiles[ty, tx] = np.full((T, T), np.nan, dtype='float32')
+                else:
+                    tiles[ty, tx] = np.load(path)
+                lattice_part, tile_part = self.overlap(ty, tx, y0, y1, x0, x1)
+                lattice[lattice_part] = tiles[ty, tx][tile_part]
+
+        # request the points that aren't cached a row of tiles at a time, 
+        # as the bounding box of those in the row, and save them in the tiles
+        for ty in range(y0 // T, y1 // T + 1):
+            band = slice(max(y0, ty*T) - y0, min(y1, ty*T + T - 1) - y0 + 1)
+            missing = np.isnan(lattice[band])
+            if not missing.any():
+                continue
+            rows = np.flatnonzero(missing.any(axis=1)) + band.start
+            cols = np.flatnonzero(missing.any(axis=0))
+            lattice[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = \
+                    self.fetch_lattice(sy, sx, y0 + rows[0], y0 + rows[-1], 
+                            x0 + cols[0], x0 + cols[-1])
+            for tx in range((x0 + cols[0]) // T, (x0 + cols[-1]) // T + 1):
+                tile = tiles[ty, tx]
+                lattice_part, tile_part = self.overlap(ty, tx, y0, y1, x0, x1)
+                tile[tile_part] = lattice[lattice_part]
+                self.disk_cache.put(self.tile_name(sy, sx, ty,
+                    tx % num_tiles_x), lambda f: np.save(f, tile))
+
+        lattice[lattice == self.void] = np.nan
+        return lattice
+
+    def overlap(self, ty, tx, y0, y1, x0, x1):
+        '''Get the slices of the lattice points y0 to y1 by x0 to x1 and of 
+        tile (ty, tx) where they overlap, or None, None if they don't'''
+        T = self.tile_size
+        r0, r1 = max(y0, ty*T), min(y1, ty*T + T - 1)
+        c0, c1 = max(x0, tx*T), min(x1, tx*T + T - 1)
+        if r0 > r1 or c0 > c1:
+            return None, None
+        return ((slice(r0 - y0, r1 - y0 + 1), slice(c0 - x0, c1 - x0 + 1)),
+                (slice(r0 - ty*T, r1 - ty*T + 1), 
+                    slice(c0 - tx*T, c1 - tx*T + 1)))
+
+    def fetch_lattice(self, sy, sx, r0, r1, c0, c1):
+        '''Request the lattice points r0 to r1 (south to north) by c0 to c1 
+        from the elevation server, with the points it has no elevation for 
+        as void'''
+        dlat = sy / 3600.0
+        dlong = sx / 3600.0
+        num_rows = r1 - r0 + 1
+        num_cols = c1 - c0 + 1
+
+        # the server's grid runs south from lat_max and east from long_min
+        lat_max = -90.0 + r1*dlat
+        long_min = self.clip_long(-180.0 + c0*dlong)
+        bbox = (lat_max - num_rows*dlat, long_min, lat_max,
+                self.clip_long(long_min + num_cols*dlong))
+        elev = self.elev_server.get_elevations(bbox, num_cols, num_rows)
+        metrics.inc('elevation_points_fetched_total', len(elev), 
+                source=self.name)
+        elev = np.array(elev, dtype=float).reshape(num_rows, num_cols)
+        return np.where(np.isnan(elev), self.void, elev)[::-1]
+
+    def tile_name(self, sy, sx, ty, tx):
+        return '{}_{}_{}_{}_{}.npy'.format(self.name, sy, sx, ty, tx)
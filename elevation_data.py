@@ -1,4 +1,8 @@
-import urllib.request, requests, json, time, math, os
+import urllib.request, requests, json, time, math, os, threading
+import numpy as np
+from scipy import ndimage
+from fetch_scheduler import FetchScheduler
+from metrics import metrics
 
 # TODO: handle latitude limits, e.g. -85 to +85 degrees
 
@@ -21,74 +25,126 @@ class ElevationData:
 
     @staticmethod
     def clip_long(long):
-        '''Utility function to clip longitudes to range -180 to +180'''
-        if long > 180.0:
-            return long - 360.0
-        elif long < -180.0:
-            return long + 360.0
-        else:
-            return long
+        '''Utility function to clip longitudes to range -180 to +180, for a 
+        longitude or an array of them'''
+        long = np.asarray(long, dtype=float)
+        long = np.where(long > 180.0, long - 360.0, 
+                np.where(long < -180.0, long + 360.0, long))
+        return long if long.ndim > 0 else float(long)
+
+    @staticmethod
+    def get_dlong(long_start, long_end):
+        '''Get the smallest longitude range between two longitudes, which may
+        cross the antimeridian'''
+        dlong = np.abs(np.asarray(long_end, dtype=float) - long_start)
+        return np.where(dlong > 180.0, 360.0 - dlong, dlong)
 
     def get_lat_long_dist(self, lat_start, long_start, lat_end, long_end):
-        lat_dist = math.fabs(lat_end - lat_start)*111045.0
+        '''Get the north-south and east-west distances (in meters) between 
+        two points, or between arrays of them'''
+        lat_dist = np.abs(np.asarray(lat_end, dtype=float) - lat_start)*111045.0
 
         # always use smallest longitude range
-        dlong = math.fabs(long_end - long_start)
-        if dlong > 180.0:
-            dlong = 360.0 - dlong
-        lat_mid = 0.5*(lat_start + lat_end)
-        r_at_lat = math.cos(math.radians(math.fabs(lat_mid)))*self.Re # radius at lat_mid
-        long_dist = r_at_lat*math.radians(dlong)
-
-        return (lat_dist, long_dist)
+        dlong = self.get_dlong(long_start, long_end)
+        lat_mid = 0.5*(np.asarray(lat_start) + lat_end)
+        r_at_lat = np.cos(np.radians(np.abs(lat_mid)))*self.Re # radius at lat_mid
+        long_dist = r_at_lat*np.radians(dlong)
+
+        return (self.to_scalar(lat_dist), self.to_scalar(long_dist))
     
     def get_square_bbox(self, lat_start, long_start, lat_end, long_end, 
             buff_mult):
-        '''Form a bounding box around start/end points with some buffer'''
+        '''Form a bounding box around start/end points with some buffer, for
+        a pair of points or arrays of them'''
         lat_dist, long_dist = self.get_lat_long_dist(lat_start, long_start,
                  lat_end, long_end)
-        d = math.sqrt(lat_dist**2 + long_dist**2)
+        d = np.sqrt(np.square(lat_dist) + np.square(long_dist))
         
-        lat_mid = 0.5*(lat_start + lat_end)
+        lat_mid = 0.5*(np.asarray(lat_start) + lat_end)
         lat_min = lat_mid - 0.5*buff_mult*d/self.Re*180.0/math.pi
         lat_max = lat_mid + 0.5*buff_mult*d/self.Re*180.0/math.pi
 
-        # always use smallest longitude range
-        dlong = math.fabs(long_end - long_start)
-        long0 = min(long_start, long_end)
-        long1 = max(long_start, long_end)
-        if dlong > 180.0:
-            dlong = 360.0 - dlong
-            long0, long1 = long1, long0            
+        # always use smallest longitude range, starting from the western
+        # point, which is the larger longitude across the antimeridian
+        dlong = self.get_dlong(long_start, long_end)
+        long0 = np.where(np.abs(np.asarray(long_end) - long_start) > 180.0, 
+                np.maximum(long_start, long_end), 
+                np.minimum(long_start, long_end))
         long_mid = self.clip_long(long0 + 0.5*dlong) 
         
-        r_at_lat = math.cos(math.radians(math.fabs(lat_mid)))*self.Re # radius at lat_mid
+        r_at_lat = np.cos(np.radians(np.abs(lat_mid)))*self.Re # radius at lat_mid
         long_min = self.clip_long(long_mid - 0.5*buff_mult*d/r_at_lat*180.0/math.pi)
         long_max = self.clip_long(long_mid + 0.5*buff_mult*d/r_at_lat*180.0/math.pi)
 
-        return (lat_min, long_min, lat_max, long_max)
+        return (self.to_scalar(lat_min), long_min, self.to_scalar(lat_max), 
+                long_max)
 
-    def get_lat_long_grid(self, lat_long_bbox, nx, ny):
+    def get_radius_bbox(self, lat, long, dist):
+        '''Form a bounding box reaching dist meters from a point to each side'''
+        dlat = dist/self.Re*180.0/math.pi
+        r_at_lat = math.cos(math.radians(math.fabs(lat)))*self.Re # radius at lat
+        dlong = min(dist/r_at_lat*180.0/math.pi, 179.0)
+        return (lat - dlat, self.clip_long(long - dlong), lat + dlat, 
+                self.clip_long(long + dlong))
+
+    def get_grid_axes(self, lat_long_bbox, nx, ny):
+        '''Get the latitudes of the grid rows, from north to south, and the 
+        longitudes of the grid columns, from west to east'''
         lat_min, long_min, lat_max, long_max = lat_long_bbox
         dlat = (lat_max - lat_min) / ny
-        dlong = math.fabs(long_max - long_min)
-        if dlong > 180.0:
-            dlong = 360.0 - dlong
-        dlong /= nx
-        
-        lat_long_list = []
-        for j in range(ny):
-            for i in range(nx):
-                long = self.clip_long(long_min + i*dlong)
-                lat = lat_max - j*dlat
-                lat_long_list.append((lat,long))
+        dlong = float(self.get_dlong(long_min, long_max)) / nx
+        lats = lat_max - dlat*np.arange(ny)
+        longs = self.clip_long(long_min + dlong*np.arange(nx))
+        return lats, longs
 
-        return lat_long_list
+    def get_lat_long_grid(self, lat_long_bbox, nx, ny):
+        '''Get the lat/long of each grid point as an (nx*ny, 2) array, ordered
+        from north to south then west to east'''
+        lats, longs = self.get_grid_axes(lat_long_bbox, nx, ny)
+        return np.column_stack((np.repeat(lats, nx), np.tile(longs, ny)))
+
+    def format_grid(self, lat_long_bbox, nx, ny, sep):
+        '''Format the grid points as 'lat,long' joined by sep, ordered like 
+        get_lat_long_grid, formatting each row and column coordinate once'''
+        lats, longs = self.get_grid_axes(lat_long_bbox, nx, ny)
+        long_text = ['%.6f' % long for long in longs.tolist()]
+        return sep.join(lat + ',' + (sep + lat + ',').join(long_text) 
+                for lat in ['%.6f' % lat for lat in lats.tolist()])
+
+    @staticmethod
+    def format_points(lat_long, sep):
+        '''Format an (n, 2) array of lat/longs as 'lat,long' joined by sep, 
+        to 6 decimal places (about 0.1 m)'''
+        if len(lat_long) == 0:
+            return ''
+        return (('%.6f,%.6f' + sep) * len(lat_long) % 
+                tuple(lat_long.ravel().tolist()))[:-len(sep)]
+
+    @staticmethod
+    def fill_voids(elev):
+        '''Replace the missing (nan) elevations of a grid with the nearest 
+        elevation that isn't missing, or with 0 if they are all missing'''
+        voids = np.isnan(elev)
+        if not voids.any():
+            return elev
+        if voids.all():
+            return np.zeros_like(elev)
+        nearest = ndimage.distance_transform_edt(voids, 
+                return_distances=False, return_indices=True)
+        return elev[tuple(nearest)]
+
+    @staticmethod
+    def to_scalar(x):
+        '''Convert a 0-d array to a float, leaving other arrays as they are'''
+        return float(x) if np.ndim(x) == 0 else x
 
 class OpenTopoData(ElevationData):
     '''Elevation data from opentopodata.org'''
-    def __init__(self):
-        self.base_url = 'https://api.opentopodata.org/'
+    # public API: 1000 calls/day, 100 locations/call, 1 call/sec
+    scheduler = FetchScheduler('OpenTopoData', max_workers=4, max_rate=1.0)
+
+    def __init__(self, base_url='https://api.opentopodata.org/'):
+        self.base_url = base_url
 
     def is_healthy(self):
         contents = urllib.request.urlopen(self.base_url+'health').read()
@@ -96,49 +152,37 @@ class OpenTopoData(ElevationData):
         return contents['status'] == 'OK'
     
     def get_elevations(self, lat_long_bbox, nx, ny):
-        lat_long_list = self.get_lat_long_grid(lat_long_bbox, nx, ny)
-        # public API: 1000 calls/day, 100 locations/call, 1 call/sec
-        # build the request by joining the locations
-        elevations = []
+        lat_long = self.get_lat_long_grid(lat_long_bbox, nx, ny)
+        # build the requests by joining up to 100 locations
         dataset = 'aster30m'
-        url = self.base_url + '/v1/' + dataset + '?locations='
-        for i,lat_long in enumerate(lat_long_list):
-            url += str(lat_long[0]) + ',' + str(lat_long[1])
-            url += '|'
-           
-            # make request if we've reached 100 locations
-            if ((i+1) % 100 == 0) or (i == len(lat_long_list)-1):
-                url = url[:-1]
-                # request the data
-                contents = urllib.request.urlopen(url).read()
-                contents = json.loads(contents)
-
-                # extract a list of elevations
-                for result in contents['results']:
-                    elevations.append(result['elevation'])
-        
-                url = self.base_url + '/v1/' + dataset + '?locations='
+        urls = [self.base_url + '/v1/' + dataset + '?locations=' + 
+                self.format_points(lat_long[i:i+100], '|')
+                for i in range(0, len(lat_long), 100)]
+
+        # request the data and extract a list of elevations
+        elevations = []
+        for contents in self.scheduler.map_json(urls):
+            for result in contents['results']:
+                elevations.append(result['elevation'])
 
         return elevations
 
 class EPQSData(ElevationData):
     '''Elevation data from nationalmap.gov/epqs'''
-    def __init__(self):
-        self.base_url = 'https://nationalmap.gov/epqs/'
+    # one location per call, so make many calls at once
+    scheduler = FetchScheduler('EPQSData', max_workers=16)
+
+    def __init__(self, base_url='https://nationalmap.gov/epqs/'):
+        self.base_url = base_url
 
     def get_elevations(self, lat_long_bbox, nx, ny):
-        lat_long_list = self.get_lat_long_grid(lat_long_bbox, nx, ny)
-        elevations = []
-        for lat_long in lat_long_list:
-            url = self.base_url + 'pqs.php?'
-            url += 'x=' + str(lat_long[0]) + '&y=' + str(lat_long[1])
-            url += '&output=json&units=Meters'
+        lat_long = self.get_lat_long_grid(lat_long_bbox, nx, ny)
+        url = self.base_url + 'pqs.php?x=%.6f&y=%.6f&output=json&units=Meters'
+        urls = [url % point for point in map(tuple, lat_long.tolist())]
         
-            # request the data
-            contents = urllib.request.urlopen(url).read()
-            contents = json.loads(contents)
-
-            # extract a list of elevations
+        # request the data and extract a list of elevations
+        elevations = []
+        for contents in self.scheduler.map_json(urls):
             elevations.append(float(contents 
                 ['USGS_Elevation_Point_Query_Service']
                 ['Elevation_Query']['Elevation']))
@@ -152,21 +196,94 @@ class BingElevData(ElevationData):
         self.api_key = os.getenv('BING_MAPS_API_KEY')
 
     def get_elevations(self, lat_long_bbox, nx, ny):
-        lat_long_list = self.get_lat_long_grid(lat_long_bbox, nx, ny)
-        body = 'points='
-        for lat_long in lat_long_list:
-            body += str(lat_long[0]) + ',' + str(lat_long[1]) + ','
-        body = body[:-1]
+        body = 'points=' + self.format_grid(lat_long_bbox, nx, ny, ',')
 
         # use POST to get large numbers of elevations
         url = self.base_url + 'List?key=' + self.api_key
         headers = {'Content-Length': str(len(body)), 
                 'Content-Type': 'text/plain; charset=utf-8'}
         r = requests.post(url, data=body, headers=headers)
+        metrics.inc('fetched_bytes_total', len(r.content), source='BingElevData')
         contents = json.loads(r.content)
         
         return contents['resourceSets'][0]['resources'][0]['elevations']
 
+class DEMData(ElevationData):
+    '''Elevation data from local SRTM .hgt files, which are memory mapped 
+    and bilinearly interpolated
+
+    Each file, e.g. N44W069.hgt, covers one degree of latitude and longitude
+    north and east of the corner in its name, as an n x n grid of big-endian 
+    int16 elevations (m) running south from its north edge and east from its
+    west edge, where n is 3601 (1 arcsecond) or 1201 (3 arcseconds). Tiles 
+    share their edge rows and columns, so every point can be interpolated 
+    from a single tile. Points in tiles with no file (the sea in SRTM) are at 
+    0 m, and voids in the data are filled from the nearest elevation.
+    '''
+    void = -32768
+    tiles = {} # path -> memory map (or None if missing), shared by instances
+    tiles_lock = threading.Lock()
+
+    def __init__(self, dem_dir):
+        self.base_url = dem_dir
+        self.api_key = ''
+        self.dem_dir = dem_dir
+
+    def is_healthy(self):
+        return os.path.isdir(self.dem_dir)
+
+    def get_elevations(self, lat_long_bbox, nx, ny):
+        lats, longs = self.get_grid_axes(lat_long_bbox, nx, ny)
+        lat_tiles = np.minimum(np.floor(lats), 89.0).astype(int)
+        long_tiles = np.minimum(np.floor(longs), 179.0).astype(int)
+        elev = np.zeros((ny, nx))
+        for lat_tile in np.unique(lat_tiles):
+            rows = np.nonzero(lat_tiles == lat_tile)[0]
+            for long_tile in np.unique(long_tiles):
+                cols = np.nonzero(long_tiles == long_tile)[0]
+                tile = self.get_tile(lat_tile, long_tile)
+                if tile is not None:
+                    elev[np.ix_(rows, cols)] = self.interpolate(tile, 
+                            lat_tile + 1.0 - lats[rows], 
+                            longs[cols] - long_tile)
+
+        # ordered like get_lat_long_grid, from north to south then west to east
+        return self.fill_voids(elev).ravel().tolist()
+
+    @classmethod
+    def interpolate(cls, tile, y, x):
+        '''Bilinearly interpolate a tile at fractions y of a degree south of
+        its north edge and x of a degree east of its west edge'''
+        n = tile.shape[0]
+        y = y * (n - 1)
+        x = x * (n - 1)
+        iy = np.clip(y.astype(int), 0, n - 2)
+        ix = np.clip(x.astype(int), 0, n - 2)
+        wy = (y - iy)[:,None]
+        wx = (x - ix)[None,:]
+        corners = [tile[np.ix_(iy + dy, ix + dx)].astype(float) 
+                for dy in (0, 1) for dx in (0, 1)]
+        for corner in corners:
+            corner[corner == cls.void] = np.nan
+        return (1.0 - wy) * ((1.0 - wx) * corners[0] + wx * corners[1]) + \
+                wy * ((1.0 - wx) * corners[2] + wx * corners[3])
+
+    def get_tile(self, lat_tile, long_tile):
+        '''Get the memory mapped tile whose south west corner is at 
+        (lat_tile, long_tile), or None if there is no file for it'''
+        path = os.path.join(self.dem_dir, '{}{:02d}{}{:03d}.hgt'.format(
+            'N' if lat_tile >= 0 else 'S', abs(lat_tile), 
+            'E' if long_tile >= 0 else 'W', abs(long_tile)))
+        with self.tiles_lock:
+            if path in self.tiles:
+                return self.tiles[path]
+            tile = None
+            if os.path.exists(path):
+                n = int(round(math.sqrt(os.path.getsize(path) / 2)))
+                tile = np.memmap(path, dtype='>i2', mode='r', shape=(n, n))
+            self.tiles[path] = tile
+            return tile
+
 if __name__ == "__main__":
     # TODO
     bmd = BingElevData()
@@ -0,0 +1,62 @@
+import threading, time
+import requests
+from metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+
+class FetchScheduler:
+    '''Runs HTTP GET requests concurrently over pooled keep-alive connections,
+    starting at most max_rate requests per second and retrying failed
+    requests with exponential backoff'''
+    retry_status_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, max_workers=8, max_rate=None, max_retries=3,
+            backoff=0.5, timeout=30.0):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # requests are started no closer together than min_interval seconds
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+    def get_json(self, url):
+        '''Request a url and return its decoded JSON contents'''
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_start()
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+                metrics.inc('fetched_bytes_total', len(r.content), 
+                        source=self.name)
+                if r.status_code not in self.retry_status_codes:
+                    r.raise_for_status()
+                    return r.json()
+                error = requests.HTTPError(str(r.status_code) +
+                        ' error for url: ' + url, response=r)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.max_retries:
+                metrics.inc('fetch_retries_total', source=self.name)
+                time.sleep(self.backoff * 2**attempt)
+        raise error
+
+    def map_json(self, urls):
+        '''Request all urls concurrently and return a list of their decoded
+        JSON contents, in the same order as urls'''
+        return list(self.executor.map(self.get_json, urls))
+
+    def wait_for_start(self):
+        '''Wait until the rate limit allows another request to start'''
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
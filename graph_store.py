@@ -0,0 +1,109 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from disk_cache import DiskCache
+from land_mask_cache import LandMaskCache
+from metrics import metrics
+
+class GraphStore:
+    '''Store of the neighbor times and land grids of whole regions, such as a
+    park, keyed by name (e.g. the elevation and map sources), bbox and grid
+    size
+
+    The arrays are saved as .npy files in a DiskCache and memory mapped when
+    they are loaded, so a path in a bbox inside a stored region can be found
+    by searching a window of the stored arrays, without recomputing or
+    copying them.
+    '''
+    quantum = 1e-5 # bbox quantization (degrees)
+
+    def __init__(self, disk_cache : DiskCache, max_open=16):
+        self.disk_cache = disk_cache
+        self.max_open = max_open
+        self.regions = OrderedDict() # name -> (neighbor_times, is_land)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # the open maps are reopened by each process
+        state = self.__dict__.copy()
+        del state['lock']
+        state['regions'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, name, lat_long_bbox, nx, ny):
+        '''Get the bbox, neighbor times and land grid of the stored region
+        with the coarsest spacing that contains lat_long_bbox with at least
+        the resolution of an nx x ny grid over it, or None if there isn't one'''
+        best_name, best_spacing = None, None
+        bbox = self.quantize(lat_long_bbox)
+        spacing = LandMaskCache.get_spacing(bbox, nx, ny)
+        for file_name in self.disk_cache.names():
+            if not file_name.endswith('_land.npy'):
+                continue
+            region_name, region_bbox, region_nx, region_ny = \
+                    self.parse_name(file_name)
+            if region_name != name:
+                continue
+            region_spacing = LandMaskCache.get_spacing(region_bbox, region_nx,
+                    region_ny)
+            if (LandMaskCache.contains(region_bbox, bbox) and
+                    np.all(region_spacing <= spacing*1.001) and
+                    (best_spacing is None or
+                        np.all(region_spacing >= best_spacing))):
+                best_name, best_spacing = file_name, region_spacing
+        arrays = None if best_name is None else self.load(best_name)
+        if arrays is None:
+            metrics.inc('cache_requests_total', cache='region_graph',
+                    result='miss')
+            return None
+        metrics.inc('cache_requests_total', cache='region_graph', result='hit')
+        return (self.parse_name(best_name)[1],) + arrays
+
+    def put(self, name, lat_long_bbox, nx, ny, neighbor_times, is_land):
+        '''Save the neighbor times and land grid of a region'''
+        base_name = self.get_name(name, lat_long_bbox, nx, ny)
+        self.disk_cache.put(base_name + '_times.npy',
+                lambda f: np.save(f, np.ascontiguousarray(neighbor_times)))
+        self.disk_cache.put(base_name + '_land.npy',
+                lambda f: np.save(f, np.ascontiguousarray(is_land)))
+
+    def load(self, land_name):
+        '''Memory map the neighbor times and land grid of a stored region, or
+        return None if either is missing'''
+        base_name = land_name[:-len('_land.npy')]
+        with self.lock:
+            arrays = self.regions.get(base_name)
+            if arrays is not None:
+                self.regions.move_to_end(base_name)
+                return arrays
+        times_path = self.disk_cache.get_path(base_name + '_times.npy')
+        land_path = self.disk_cache.get_path(land_name)
+        if times_path is None or land_path is None:
+            return None
+        # the maps stay valid even if the files are evicted from the cache
+        arrays = (np.load(times_path, mmap_mode='r'),
+                np.load(land_path, mmap_mode='r'))
+        with self.lock:
+            self.regions[base_name] = arrays
+            self.regions.move_to_end(base_name)
+            if len(self.regions) > self.max_open:
+                self.regions.popitem(last=False)
+        return arrays
+
+    def quantize(self, lat_long_bbox):
+        return tuple(round(v / self.quantum) * self.quantum
+                for v in lat_long_bbox)
+
+    def get_name(self, name, lat_long_bbox, nx, ny):
+        return '{}_{}_{}_{}_{}_{}_{}'.format(name,
+                *[round(v / self.quantum) for v in lat_long_bbox], nx, ny)
+
+    def parse_name(self, file_name):
+        '''Get the name, bbox and grid size from a stored file name'''
+        fields = file_name.rsplit('_', 7)
+        bbox = tuple(int(v) * self.quantum for v in fields[1:5])
+        return fields[0], bbox, int(fields[5]), int(fields[6])
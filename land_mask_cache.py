@@ -0,0 +1,136 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from disk_cache import DiskCache
+from metrics import metrics
+
+class LandMaskCache:
+    '''Cache of land/water grids from PathFinder.get_land_grid, keyed by map
+    source, quantized bbox and grid size
+
+    Grids are kept bit-packed in a small in-memory LRU cache and in a
+    DiskCache. A grid that isn't cached can still be sampled from a cached
+    grid that covers its bbox with at least the same resolution.
+    '''
+    quantum = 1e-5 # bbox quantization (degrees)
+
+    def __init__(self, disk_cache : DiskCache, max_entries=64):
+        self.disk_cache = disk_cache
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # name -> (packed bits, shape)
+        self.lock = threading.Lock()
+
+    def get(self, map_name, lat_long_bbox, nx, ny):
+        '''Get the land grid for a map source and bbox, or None if it can't be
+        served from the cache'''
+        name = self.get_name(map_name, lat_long_bbox, nx, ny)
+        is_land = self.load(name)
+        if is_land is not None:
+            metrics.inc('cache_requests_total', cache='land_mask', result='hit')
+            return is_land
+
+        # otherwise sample the coarsest cached grid that can serve this one
+        best_name, best_spacing = None, None
+        bbox = self.quantize(lat_long_bbox)
+        for other_name in list(self.entries) + self.disk_cache.names():
+            other_map_name, other_bbox, other_nx, other_ny = \
+                    self.parse_name(other_name)
+            if other_map_name != map_name:
+                continue
+            spacing = self.get_spacing(other_bbox, other_nx, other_ny)
+            if (self.contains(other_bbox, bbox) and
+                    np.all(spacing <= self.get_spacing(bbox, nx, ny)*1.001) and
+                    (best_spacing is None or np.all(spacing >= best_spacing))):
+                best_name, best_spacing = other_name, spacing
+        other = None if best_name is None else self.load(best_name)
+        if other is None:
+            metrics.inc('cache_requests_total', cache='land_mask', result='miss')
+            return None
+        metrics.inc('cache_requests_total', cache='land_mask', result='window')
+        return self.sample(other, self.parse_name(best_name)[1], bbox, nx, ny)
+
+    def put(self, map_name, lat_long_bbox, nx, ny, is_land):
+        '''Add a land grid to the cache'''
+        name = self.get_name(map_name, lat_long_bbox, nx, ny)
+        bits = np.packbits(is_land)
+        self.remember(name, bits, is_land.shape)
+        self.disk_cache.put(name,
+                lambda f: np.savez(f, bits=bits, shape=is_land.shape))
+
+    def load(self, name):
+        '''Load a cached grid from memory or disk, or return None'''
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self.entries.move_to_end(name)
+        if entry is None:
+            path = self.disk_cache.get_path(name)
+            if path is None:
+                return None
+            with np.load(path) as data:
+                entry = (data['bits'], tuple(data['shape']))
+            self.remember(name, *entry)
+        bits, shape = entry
+        return np.unpackbits(bits, count=shape[0]*shape[1]).reshape(
+                shape).astype(bool)
+
+    def remember(self, name, bits, shape):
+        with self.lock:
+            self.entries[name] = (bits, shape)
+            self.entries.move_to_end(name)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def sample(is_land, bbox, sub_bbox, nx, ny):
+        '''Sample the nearest grid points of is_land, over bbox, at the grid
+        point centers of an nx x ny grid over sub_bbox'''
+        lat_min, long_min, lat_max, long_max = bbox
+        sub_lat_min, sub_long_min, sub_lat_max, sub_long_max = sub_bbox
+        dlong = LandMaskCache.get_dlong(long_min, long_max)
+        sub_dlong = LandMaskCache.get_dlong(sub_long_min, sub_long_max)
+        longs = (sub_long_min - long_min) % 360.0 + \
+                (np.arange(nx) + 0.5) * sub_dlong / nx
+        lats = sub_lat_max - (np.arange(ny) + 0.5) * \
+                (sub_lat_max - sub_lat_min) / ny
+        ix = (longs * is_land.shape[0] / dlong).astype(int)
+        iy = ((lat_max - lats) * is_land.shape[1] / (lat_max - lat_min)).astype(int)
+        ix = np.clip(ix, 0, is_land.shape[0] - 1)
+        iy = np.clip(iy, 0, is_land.shape[1] - 1)
+        return is_land[np.ix_(ix, iy)]
+
+    @staticmethod
+    def get_dlong(long_min, long_max):
+        '''Get the width of a longitude range, which may cross the
+        antimeridian'''
+        return (long_max - long_min) % 360.0
+
+    @staticmethod
+    def get_spacing(bbox, nx, ny):
+        lat_min, long_min, lat_max, long_max = bbox
+        return np.array([LandMaskCache.get_dlong(long_min, long_max) / nx,
+            (lat_max - lat_min) / ny])
+
+    @staticmethod
+    def contains(bbox, sub_bbox):
+        '''Check if bbox contains sub_bbox'''
+        lat_min, long_min, lat_max, long_max = bbox
+        sub_lat_min, sub_long_min, sub_lat_max, sub_long_max = sub_bbox
+        long_offset = (sub_long_min - long_min) % 360.0
+        return (lat_min <= sub_lat_min and sub_lat_max <= lat_max and
+                long_offset + LandMaskCache.get_dlong(sub_long_min,
+                    sub_long_max) <= LandMaskCache.get_dlong(long_min, long_max))
+
+    def quantize(self, lat_long_bbox):
+        return tuple(round(v / self.quantum) * self.quantum
+                for v in lat_long_bbox)
+
+    def get_name(self, map_name, lat_long_bbox, nx, ny):
+        return '{}_{}_{}_{}_{}_{}_{}.npz'.format(map_name,
+                *[round(v / self.quantum) for v in lat_long_bbox], nx, ny)
+
+    def parse_name(self, name):
+        '''Get the map source, bbox and grid size from a cache file name'''
+        fields = name[:-len('.npz')].split('_')
+        bbox = tuple(int(v) * self.quantum for v in fields[1:5])
+        return fields[0], bbox, int(fields[5]), int(fields[6])
@@ -1,4 +1,6 @@
-import urllib.request, requests, json, os
+import urllib.request, requests, json, os, math
+from metrics import metrics
+from ttl_cache import TTLCache
 
 class MapData:
     '''Base class for map data objects, which are responsible for 
@@ -33,9 +35,13 @@ class MapData:
 
 class BingMapData(MapData):
     '''Map data from Bing Maps'''
+    # image metadata remembered by (bbox, res), which never goes stale
+    metadata_cache_size = 256
+
     def __init__(self):
         self.base_url = 'http://dev.virtualearth.net/REST/v1/Imagery/Map/'
         self.api_key = os.getenv('BING_MAPS_API_KEY')
+        self.metadata_cache = TTLCache(self.metadata_cache_size, math.inf)
 
     def get_satellite_image_url(self, lat_long_bbox, res):
         # get the url for the specified area
@@ -48,18 +54,29 @@ class BingMapData(MapData):
         return url
     
     def get_image_metadata(self, lat_long_bbox, res):
+        key = (tuple(float(v) for v in lat_long_bbox), tuple(res))
+        metadata = self.metadata_cache.get(key)
+        metrics.inc('cache_requests_total', cache='image_metadata', 
+                result='miss' if metadata is None else 'hit')
+        if metadata is None:
+            metadata = self.fetch_image_metadata(lat_long_bbox, res)
+            self.metadata_cache.put(key, metadata)
+        return metadata
+
+    def fetch_image_metadata(self, lat_long_bbox, res):
         # get the image metadata
         url = self.get_satellite_image_url(lat_long_bbox, res) + self.get_api_key()
         url += '&mmd=1'
 
         contents = urllib.request.urlopen(url).read()
+        metrics.inc('fetched_bytes_total', len(contents), source='BingMapData')
         contents = json.loads(contents)
         
         bbox = contents['resourceSets'][0]['resources'][0]['bbox']
         imageHeight = int(contents['resourceSets'][0]['resources'][0]['imageHeight'])
         imageWidth = int(contents['resourceSets'][0]['resources'][0]['imageWidth'])
 
-        return (bbox, imageHeight, imageWidth)
+        return (tuple(bbox), imageHeight, imageWidth)
     
     def get_water_image_url(self, lat_long_bbox, res):
         # get the url for the specified area
@@ -0,0 +1,90 @@
+import threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class Metrics:
+    '''Thread-safe registry of counters and stage timers, which can be
+    rendered in the Prometheus text format'''
+
+    def __init__(self, prefix='hykr'):
+        self.prefix = prefix
+        self.counters = defaultdict(float) # (name, labels) -> value
+        self.stages = defaultdict(lambda: [0.0, 0]) # stage -> [seconds, count]
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        '''Increase a counter, identified by its name and labels'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe_stage(self, stage, seconds):
+        '''Record the time taken by one run of a stage'''
+        with self.lock:
+            self.stages[stage][0] += seconds
+            self.stages[stage][1] += 1
+
+    def render(self):
+        '''Render all counters and stage timers in the Prometheus text format'''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            stages = sorted((stage, list(v)) for stage, v in self.stages.items())
+
+        lines = []
+        if len(stages) > 0:
+            name = self.prefix + '_stage_seconds'
+            lines.append('# TYPE ' + name + ' summary')
+            for stage, (seconds, count) in stages:
+                labels = self.format_labels((('stage', stage),))
+                lines.append(name + '_sum' + labels + ' ' + repr(seconds))
+                lines.append(name + '_count' + labels + ' ' + str(count))
+        last_name = None
+        for (name, labels), value in counters:
+            name = self.prefix + '_' + name
+            if name != last_name:
+                lines.append('# TYPE ' + name + ' counter')
+                last_name = name
+            if value == int(value):
+                value = int(value)
+            lines.append(name + self.format_labels(labels) + ' ' + repr(value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(labels):
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace(
+            '"', '\\"') + '"' for k, v in labels) + '}'
+
+# registry shared by the whole process, served by the /metrics route
+metrics = Metrics()
+
+class StageTimings:
+    '''Wall-clock time spent in each stage of a single request, which is also
+    recorded in a Metrics registry'''
+
+    def __init__(self, registry : Metrics = metrics):
+        self.registry = registry
+        self.timings = {} # stage -> seconds
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager that times a stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.registry.observe_stage(name, seconds)
+
+    def timed(self, name, func, *args, **kwargs):
+        '''Call a function, timing it as a stage'''
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+    def add(self, timings):
+        '''Add stage times measured elsewhere, such as in a search process'''
+        for name, seconds in timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.registry.observe_stage(name, seconds)
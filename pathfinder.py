@@ -1,11 +1,15 @@
 from PIL import Image
 from io import BytesIO
-import math, requests
+import math, requests, heapq, functools
 import numpy as np
-from scipy import interpolate
+from scipy import ndimage
 from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
 from map_data import *
-from priority_queue import *
+from elevation_data import ElevationData
+from land_mask_cache import LandMaskCache
+from graph_store import GraphStore
+from metrics import StageTimings, metrics
 
 class PathFinderResult(IntEnum):
     '''Enum for result of pathfinding'''
@@ -14,48 +18,270 @@ class PathFinderResult(IntEnum):
     INVALID_END = 3
     NO_VALID_PATH = 4
 
-class NodeTimePair():
-    """Wraps a node and its corresponding travel time in the priority queue"""
-    
-    def __init__(self, node, time):
-        """Creates a NodeTimePair to be used as a key in the priority queue"""
-        self.node = node
-        self.time = time
-        
-    def __lt__(self, other):
-        # :nodoc: Delegate comparison to time.
-        return (self.time < other.time or 
-                (self.time == other.time and 
-                 id(self.node) < id(other.node)))
-    
-    def __le__(self, other):
-        # :nodoc: Delegate comparison to time.
-        return (self.time < other.time or
-                (self.time == other.time and 
-                 id(self.node) <= id(other.node)))
-                
-    def __gt__(self, other):
-        # :nodoc: Delegate comparison to time.
-        return (self.time > other.time or
-                (self.time == other.time and 
-                 id(self.node) > id(other.node)))
-    
-    def __ge__(self, other):
-        # :nodoc: Delegate comparison to time.
-        return (self.time > other.time or
-                (self.time == other.time and 
-                 id(self.node) >= id(other.node)))
+class SearchCancelled(Exception):
+    '''Raised by a progress callback to stop a search nobody is waiting on'''
+    pass
 
 class PathFinder:
     '''Base class for path finding objects'''
-    def __init__(self):
-        pass
+    # grid offsets (di, dj) to each neighbor, ordered (N, NE, E, SE, S, SW, W, NW)
+    neighbor_offsets = ((0,1), (1,1), (1,0), (1,-1), (0,-1), (-1,-1), (-1,0), (-1,1))
+    # Tobler's maximum walking speed (m/s), reached on a -5% slope
+    max_speed = 6.0 / 3.6
+    # rows of the water image checked at a time when voting on land cells
+    land_band_rows = 512
+    # rows of the movement grid interpolated at a time, bounding the memory 
+    # used when the elevation grid is large
+    interpolation_block = 256
+
+    def __init__(self, land_mask_cache : LandMaskCache = None, 
+            timings : StageTimings = None, graph_store : GraphStore = None,
+            land_majority=False):
+        self.land_mask_cache = land_mask_cache
+        self.timings = timings if timings is not None else StageTimings()
+        self.graph_store = graph_store
+
+        # a grid point is on land if most of its cell's pixels in the water 
+        # image are, rather than only the pixel at the grid point
+        self.land_majority = land_majority
+
+        # called with the times to each flat node index every 
+        # progress_interval settled nodes while searching, and can raise 
+        # SearchCancelled to stop the search
+        self.progress = None
+        self.progress_interval = 1000
+
+        # counts from the last search
+        self.num_visited = 0 # nodes settled
+        self.num_pushes = 0 # heap insertions
+        self.num_decrease_keys = 0 # heap insertions that lowered a node's time
+
+    def __getstate__(self):
+        # sent to search processes without the per-request hooks, and with 
+        # is_land given so the land mask cache isn't needed
+        state = self.__dict__.copy()
+        state.update(land_mask_cache=None, timings=None, progress=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.timings = StageTimings()
 
     def get_optimal_path(self, lat_start, long_start, lat_end, long_end, 
             lat_long_bbox, lat_dist, long_dist, nx, ny, elev2d, 
-            map_server : MapData):
-        '''Determine the optimal path between two points'''
-        raise NotImplementedError('You need to define get_optimal_path!')
+            map_server : MapData, is_land=None, graph_name=None):
+        '''Determine the optimal path between two points, optionally with the 
+        land grid from get_land_grid already fetched
+
+        If graph_name is given and the graph store holds a region under that 
+        name which covers the bbox, the path is found in that region's graph
+        instead, and is returned in fractional grid indices
+        '''
+        if self.graph_store is not None and graph_name is not None:
+            region = self.graph_store.get(graph_name, lat_long_bbox, nx, ny)
+            if region is not None:
+                return self.get_region_path(region, lat_start, long_start, 
+                        lat_end, long_end, lat_long_bbox, lat_dist, long_dist,
+                        nx, ny)
+
+        is_land, neighbor_times = self.get_graph(lat_long_bbox, lat_dist, 
+                long_dist, nx, ny, elev2d, map_server, is_land)
+       
+        # check if start/end points are valid
+        si, sj, ei, ej, valid = self.check_start_end_validity(lat_start, 
+                long_start, lat_end, long_end, lat_long_bbox, is_land)
+        if (valid == PathFinderResult.INVALID_START or 
+                valid == PathFinderResult.INVALID_END):
+            return valid, []
+
+        # search between the flattened start and end nodes
+        with self.timings.stage('search'):
+            return self.find_path(neighbor_times, si*ny + sj, ei*ny + ej, 
+                    long_dist / nx, lat_dist / ny)
+
+    def get_optimal_paths(self, legs, lat_long_bbox, lat_dist, long_dist, 
+            nx, ny, elev2d, map_server : MapData, is_land=None, 
+            graph_name=None):
+        '''Determine the optimal paths of many legs, each a tuple (lat_start,
+        long_start, lat_end, long_end), on one graph over lat_long_bbox, with
+        one search from each start point where the search allows it, or in 
+        a stored region's graph as in get_optimal_path
+
+        Returns a list of (result, path) in the order of legs, and leaves the
+        counts summed over all the searches
+        '''
+        if self.graph_store is not None and graph_name is not None:
+            region = self.graph_store.get(graph_name, lat_long_bbox, nx, ny)
+            if region is not None:
+                return self.get_region_paths(region, legs, lat_long_bbox, 
+                        lat_dist, long_dist, nx, ny)
+
+        is_land, neighbor_times = self.get_graph(lat_long_bbox, lat_dist, 
+                long_dist, nx, ny, elev2d, map_server, is_land)
+
+        # group the valid legs by their start node
+        results = [None] * len(legs)
+        targets = {} # source -> [(leg index, target)]
+        for k, (lat_start, long_start, lat_end, long_end) in enumerate(legs):
+            si, sj = self.get_grid_indices(lat_start, long_start, 
+                    lat_long_bbox, nx, ny)
+            ei, ej = self.get_grid_indices(lat_end, long_end, lat_long_bbox, 
+                    nx, ny)
+            if not (0 <= si < nx and 0 <= sj < ny and is_land[si,sj]):
+                results[k] = (PathFinderResult.INVALID_START, [])
+            elif not (0 <= ei < nx and 0 <= ej < ny and is_land[ei,ej]):
+                results[k] = (PathFinderResult.INVALID_END, [])
+            else:
+                targets.setdefault(si*ny + sj, []).append((k, ei*ny + ej))
+
+        counts = [0, 0, 0]
+        with self.timings.stage('search'):
+            for source, source_targets in targets.items():
+                paths = self.find_paths(neighbor_times, source, 
+                        [target for k, target in source_targets], 
+                        long_dist / nx, lat_dist / ny)
+                for (k, target), result in zip(source_targets, paths):
+                    results[k] = result
+                counts = [c + n for c, n in zip(counts, (self.num_visited, 
+                    self.num_pushes, self.num_decrease_keys))]
+        self.num_visited, self.num_pushes, self.num_decrease_keys = counts
+        return results
+
+    def get_graph(self, lat_long_bbox, lat_dist, long_dist, nx, ny, elev2d, 
+            map_server : MapData, is_land=None):
+        '''Find the valid grid points, unless is_land is given, and compute 
+        the time between neighbors'''
+        if is_land is None:
+            is_land = self.get_land_grid(lat_long_bbox, nx, ny, map_server)
+        neighbor_times = self.compute_neighbor_times(is_land, elev2d, 
+                lat_dist, long_dist)
+        return is_land, neighbor_times
+
+    def build_region(self, graph_name, lat_long_bbox, lat_dist, long_dist, 
+            nx, ny, elev2d, map_server : MapData, is_land=None):
+        '''Compute the graph of a region and save it in the graph store'''
+        is_land, neighbor_times = self.get_graph(lat_long_bbox, lat_dist, 
+                long_dist, nx, ny, elev2d, map_server, is_land)
+        self.graph_store.put(graph_name, lat_long_bbox, nx, ny, 
+                neighbor_times, is_land)
+
+    def get_region_land_grid(self, region, lat_long_bbox, nx, ny):
+        '''Get the land grid of an nx x ny grid over lat_long_bbox from the 
+        nearest points of a stored region's land grid, which covers it'''
+        region_bbox, neighbor_times, is_land = region
+        region_nx, region_ny = is_land.shape
+        i, j = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+        lat, long = self.get_lat_long(i, j, lat_long_bbox, nx, ny)
+        x, y = self.get_grid_position(lat, long, region_bbox, region_nx, 
+                region_ny)
+        return is_land[np.clip(np.rint(x).astype(int), 0, region_nx - 1),
+                np.clip(np.rint(y).astype(int), 0, region_ny - 1)]
+
+    def get_region_paths(self, region, legs, lat_long_bbox, lat_dist, 
+            long_dist, nx, ny):
+        '''Determine the optimal paths of many legs within the window of a 
+        stored region's graph that covers lat_long_bbox, leaving the counts 
+        summed over the searches'''
+        results = []
+        counts = [0, 0, 0]
+        for lat_start, long_start, lat_end, long_end in legs:
+            si, sj = self.get_grid_indices(lat_start, long_start, 
+                    lat_long_bbox, nx, ny)
+            ei, ej = self.get_grid_indices(lat_end, long_end, lat_long_bbox, 
+                    nx, ny)
+            if not (0 <= si < nx and 0 <= sj < ny):
+                results.append((PathFinderResult.INVALID_START, []))
+                continue
+            if not (0 <= ei < nx and 0 <= ej < ny):
+                results.append((PathFinderResult.INVALID_END, []))
+                continue
+            self.num_visited = self.num_pushes = self.num_decrease_keys = 0
+            results.append(self.get_region_path(region, lat_start, long_start,
+                lat_end, long_end, lat_long_bbox, lat_dist, long_dist, nx, 
+                ny))
+            counts = [c + n for c, n in zip(counts, (self.num_visited, 
+                self.num_pushes, self.num_decrease_keys))]
+        self.num_visited, self.num_pushes, self.num_decrease_keys = counts
+        return results
+
+    def get_region_path(self, region, lat_start, long_start, lat_end, 
+            long_end, lat_long_bbox, lat_dist, long_dist, nx, ny):
+        '''Determine the optimal path between two points within the window of
+        a stored region's graph that covers lat_long_bbox, returning the path 
+        in fractional grid indices of an nx x ny grid over lat_long_bbox'''
+        region_bbox, neighbor_times, is_land = region
+        region_nx, region_ny = is_land.shape
+
+        # find the window of region grid points covering the bbox
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        x, y = self.get_grid_position(np.array([lat_max, lat_min]), 
+                np.array([long_min, long_max]), region_bbox, region_nx, 
+                region_ny)
+        window = (max(int(math.floor(x[0])), 0), 
+                min(int(math.ceil(x[1])), region_nx - 1),
+                max(int(math.floor(y[0])), 0), 
+                min(int(math.ceil(y[1])), region_ny - 1))
+
+        # check if start/end points are valid, i.e. in the window and on land
+        si, sj, ei, ej, valid = self.check_start_end_validity(lat_start, 
+                long_start, lat_end, long_end, region_bbox, is_land)
+        if not (window[0] <= si <= window[1] and window[2] <= sj <= window[3]):
+            valid = PathFinderResult.INVALID_START
+        elif not (window[0] <= ei <= window[1] and window[2] <= ej <= window[3]):
+            valid = PathFinderResult.INVALID_END
+        if (valid == PathFinderResult.INVALID_START or 
+                valid == PathFinderResult.INVALID_END):
+            return valid, []
+
+        # the region's grid spacing, from the ratio to the bbox's spacing
+        region_lat_min, region_long_min, region_lat_max, region_long_max = \
+                region_bbox
+        dx = long_dist / nx * ((region_long_max - region_long_min) / 
+                region_nx) / ((long_max - long_min) / nx)
+        dy = lat_dist / ny * ((region_lat_max - region_lat_min) / 
+                region_ny) / ((lat_max - lat_min) / ny)
+
+        # search only the window's neighbor times, so that the search's 
+        # arrays are the size of the window rather than of the region
+        i_min, i_max, j_min, j_max = window
+        window_nx, window_ny = i_max - i_min + 1, j_max - j_min + 1
+        window_times = np.ascontiguousarray(
+                neighbor_times[i_min:i_max+1, j_min:j_max+1])
+        with self.timings.stage('search'):
+            result, path = self.find_path(window_times, 
+                    (si - i_min)*window_ny + sj - j_min, 
+                    (ei - i_min)*window_ny + ej - j_min, dx, dy, 
+                    (0, window_nx - 1, 0, window_ny - 1))
+        if result != PathFinderResult.OK:
+            return result, path
+
+        # convert the path to grid indices over the bbox
+        path = np.array(path, dtype=float).reshape(-1, 2) + [i_min, j_min]
+        lat, long = self.get_lat_long(path[:,0], path[:,1], region_bbox, 
+                region_nx, region_ny)
+        x, y = self.get_grid_position(lat, long, lat_long_bbox, nx, ny)
+        return result, np.column_stack((x, y)).ravel().tolist()
+
+    def find_path(self, neighbor_times, source, target, dx, dy, window=None):
+        '''Search for the optimal path between flat node indices (i*ny + j) 
+        source and target on a grid with spacing dx, dy and return the result
+        and the path, optionally only through the grid points in the window 
+        (i_min, i_max, j_min, j_max)'''
+        raise NotImplementedError('You need to define find_path!')
+
+    def find_paths(self, neighbor_times, source, targets, dx, dy):
+        '''Search for the optimal paths from source to each of the targets 
+        and return a list of (result, path), leaving the counts summed over 
+        the searches'''
+        paths = []
+        counts = [0, 0, 0]
+        for target in targets:
+            paths.append(self.find_path(neighbor_times, source, target, dx, 
+                dy))
+            counts = [c + n for c, n in zip(counts, (self.num_visited, 
+                self.num_pushes, self.num_decrease_keys))]
+        self.num_visited, self.num_pushes, self.num_decrease_keys = counts
+        return paths
 
     @staticmethod
     def walking_time(h_from, h_to, dx):
@@ -72,23 +298,47 @@ class PathFinder:
         else:
             return dx / speed
 
+    @staticmethod
+    def walking_times(h_from, h_to, dx):
+        '''Array version of walking_time, applied elementwise to arrays of 
+        heights h_from and h_to'''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dh_dx = (h_from - h_to) / dx
+            speed = 6.0 * np.exp(-3.5 * np.abs(dh_dx + 0.05)) / 3.6
+            times = dx / speed # zero speed gives infinite time
+        times[np.isinf(h_from) | np.isinf(h_to)] = np.inf
+        return times
+
     def get_land_grid(self, lat_long_bbox, nx, ny, map_server : MapData):
-        '''Determine which grid points are on land and which are under water''' 
+        '''Determine which grid points are on land and which are under water, 
+        using the land mask cache if there is one''' 
+        if self.land_mask_cache is None:
+            return self.download_land_grid(lat_long_bbox, nx, ny, map_server)
+
+        map_name = type(map_server).__name__
+        if self.land_majority:
+            map_name += '-majority'
+        is_land = self.land_mask_cache.get(map_name, lat_long_bbox, nx, ny)
+        if is_land is None:
+            is_land = self.download_land_grid(lat_long_bbox, nx, ny, map_server)
+            self.land_mask_cache.put(map_name, lat_long_bbox, nx, ny, is_land)
+        return is_land
+
+    def download_land_grid(self, lat_long_bbox, nx, ny, map_server : MapData):
+        '''Determine which grid points are on land and which are under water
+        from a map image''' 
         # get the image used to determine the locations of water
         res = (5*nx,5*ny) 
         url = map_server.get_water_image_url(lat_long_bbox, res) + \
                 map_server.get_api_key()
-        img = Image.open(requests.get(url, stream=True).raw).convert('RGB')
+        contents = requests.get(url).content
+        metrics.inc('fetched_bytes_total', len(contents), 
+                source=type(map_server).__name__)
+        img = Image.open(BytesIO(contents)).convert('RGB')
         bbox, yres, xres = map_server.get_image_metadata(lat_long_bbox, res)
 
-        # determine which pixels are covered by water
-        img_rgb = np.array(img)
-        water_rgb = map_server.get_water_rgb()
-        rgb_tol = 25000 # average difference of ~90 in each channel
-        land_pixels = np.sum((img_rgb - water_rgb)**2, axis=2) > rgb_tol
-        land_pixels = np.transpose(land_pixels)
-
-        # determine which graph nodes are covered by water
+        # find the pixel at each graph node and the pixels at the edges of 
+        # the cells around the nodes
         lat_min, long_min, lat_max, long_max = lat_long_bbox
         dlong = long_max - long_min
         dlat = lat_max - lat_min
@@ -98,78 +348,201 @@ class PathFinder:
         shift_y = int(yres*(lat_min - bbox[0])/dlat_img)
         width_x = xres*dlong/dlong_img/nx
         width_y = yres*dlat/dlat_img/ny
-        start_x = int(shift_x + width_x/2)
-        start_y = int(shift_y + width_y/2)
-        ix = np.zeros(nx, dtype='int32')
-        for i in range(nx):
-            ix[i] = start_x + int(width_x*i)
-        iy = np.zeros(ny, dtype='int32')
-        for j in range(ny):
-            iy[j] = start_y + int(width_y*j)
-        is_land = land_pixels[np.ix_(ix,iy)]
+        ix = int(shift_x + width_x/2) + (width_x*np.arange(nx)).astype(int)
+        iy = int(shift_y + width_y/2) + (width_y*np.arange(ny)).astype(int)
+
+        # determine which graph nodes are covered by water, from the pixel at
+        # each node or the majority of the pixels in each node's cell
+        img_rgb = np.asarray(img)
+        water_rgb = np.array(map_server.get_water_rgb(), dtype=np.int32)
+        is_land = self.is_land_pixel(img_rgb[np.ix_(iy, ix)], water_rgb).T
+        if self.land_majority:
+            x_edges = np.clip(shift_x + (width_x*np.arange(nx + 1)).astype(int),
+                    0, img_rgb.shape[1])
+            y_edges = np.clip(shift_y + (width_y*np.arange(ny + 1)).astype(int),
+                    0, img_rgb.shape[0])
+            votes = self.count_land_pixels(img_rgb, water_rgb, x_edges, y_edges)
+            sizes = np.outer(np.diff(x_edges), np.diff(y_edges))
+            # cells without pixels keep the pixel at their node
+            is_land = np.where(sizes > 0, 2*votes >= sizes, is_land)
         # Image.fromarray(is_land).save("land.png")
 
         return is_land
 
+    @staticmethod
+    def is_land_pixel(rgb, water_rgb):
+        '''Check which pixels of a uint8 RGB image aren't the water color'''
+        rgb_tol = 25000 # average difference of ~90 in each channel
+        diff = rgb.astype(np.int32)
+        diff -= water_rgb
+        diff *= diff
+        return diff.sum(axis=-1) > rgb_tol
+
+    def count_land_pixels(self, img_rgb, water_rgb, x_edges, y_edges):
+        '''Count the land pixels in each cell of a grid over an image, with 
+        cell (i, j) spanning columns x_edges[i] to x_edges[i+1] and rows 
+        y_edges[j] to y_edges[j+1], a band of land_band_rows rows at a time'''
+        votes = np.zeros((len(x_edges) - 1, len(y_edges) - 1), dtype=np.int64)
+        j = 0
+        while j < len(y_edges) - 1:
+            # the band of whole cell rows starting at cell row j
+            j_end = max(np.searchsorted(y_edges, y_edges[j] + 
+                self.land_band_rows, side='right') - 1, j + 1)
+            rows = slice(y_edges[j], y_edges[j_end])
+            land = self.is_land_pixel(img_rgb[rows], water_rgb)
+
+            # sum the land pixels in each cell, by differences of cumulative 
+            # sums at the cell edges
+            counts = np.zeros((land.shape[0] + 1, land.shape[1] + 1), 
+                    dtype=np.int32)
+            np.cumsum(land, axis=1, out=counts[1:,1:])
+            np.cumsum(counts, axis=0, out=counts)
+            counts = counts[:,x_edges]
+            counts = counts[y_edges[j:j_end+1] - y_edges[j]]
+            votes[:,j:j_end] = np.diff(np.diff(counts, axis=0), axis=1).T
+            j = j_end
+        return votes
+
     def compute_neighbor_times(self, is_land, elev, lat_dist, long_dist):
         '''Compute the travel time between each grid point and its 8 neighbors''' 
         nx = is_land.shape[0]
         ny = is_land.shape[1]
 
         # interpolate elevations on movement grid
-        nx_elev = elev.shape[0]
-        ny_elev = elev.shape[1]
-        x = np.linspace(0,1,nx_elev)
-        y = np.linspace(0,1,ny_elev)
-        interp = interpolate.RectBivariateSpline(x, y, elev)
-        elev_interp = interp(np.linspace(0,1,nx), np.linspace(0,1,ny))
+        with self.timings.stage('interpolation'):
+            elev_interp = self.resample(elev, nx, ny)
 
-        # set height in water grid points to infinity
-        elev_interp = np.where(is_land, elev_interp, np.inf)
+        # set height in water grid points, and where the elevation is 
+        # missing, to infinity so they can't be walked through
+        elev_interp = np.where(is_land & np.isfinite(elev_interp), elev_interp, 
+                np.inf)
 
         # ordering is (N, NE, E, SE, S, SW, W, NW)
         #              0  1   2  3   4  5   6  7
-        neighbor_times = np.full((nx,ny,8), np.inf)
-        dx = long_dist / nx
-        dy = lat_dist / ny
-        dxy = math.sqrt(dx**2 + dy**2)
-        # N
-        neighbor_times[:,:-1,0] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i,j+1], dy) for j in range(0,ny-1)] for i in range(0,nx)])
-        # NE
-        neighbor_times[:-1,:-1,1] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i+1,j+1], dxy) for j in range(0,ny-1)] for i in range(0,nx-1)])
-        # E
-        neighbor_times[:-1,:,2] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i+1,j], dx) for j in range(0,ny)] for i in range(0,nx-1)])
-        # SE
-        neighbor_times[:-1,1:,3] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i+1,j-1], dxy) for j in range(1,ny)] for i in range(0,nx-1)])
-        # S
-        neighbor_times[:,1:,4] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i,j-1], dy) for j in range(1,ny)] for i in range(0,nx)])
-        # SW
-        neighbor_times[1:,1:,5] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i-1,j-1], dxy) for j in range(1,ny)] for i in range(1,nx)])
-        # W
-        neighbor_times[1:,:,6] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i-1,j], dx) for j in range(0,ny)] for i in range(1,nx)])
-        # NW
-        neighbor_times[1:,:-1,7] = np.array([[self.walking_time(elev_interp[i,j], 
-            elev_interp[i-1,j+1], dxy) for j in range(0,ny-1)] for i in range(1,nx)])
+        with self.timings.stage('edge_costs'):
+            neighbor_times = np.full((nx,ny,8), np.inf)
+            dx = long_dist / nx
+            dy = lat_dist / ny
+            dxy = math.sqrt(dx**2 + dy**2)
+            dists = (dy, dxy, dx, dxy, dy, dxy, dx, dxy)
+            for n, src, dst in self.neighbor_slices(nx, ny):
+                neighbor_times[src + (n,)] = self.walking_times(
+                        elev_interp[src], elev_interp[dst], dists[n])
 
         return neighbor_times
 
+    def resample(self, elev, nx, ny):
+        '''Bilinearly interpolate a grid of elevations onto an nx x ny grid 
+        spanning the same bbox, a block of interpolation_block rows at a time,
+        or return it as is if it already has that shape'''
+        elev = np.asarray(elev, dtype=float)
+        if elev.shape == (nx, ny):
+            return elev
+        i_lo, i_hi, wi = self.interpolation_weights(elev.shape[0], nx)
+        j_lo, j_hi, wj = self.interpolation_weights(elev.shape[1], ny)
+        wi = wi[:,np.newaxis]
+
+        # interpolate along i, then along j, in blocks of rows
+        elev_interp = np.empty((nx, ny))
+        for start in range(0, nx, self.interpolation_block):
+            s = slice(start, start + self.interpolation_block)
+            rows = elev[i_lo[s]]*(1.0 - wi[s]) + elev[i_hi[s]]*wi[s]
+            elev_interp[s] = rows[:,j_lo]*(1.0 - wj) + rows[:,j_hi]*wj
+        return elev_interp
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def interpolation_weights(n_from, n_to):
+        '''Get the indices lo and hi of the points on either side of each of
+        n_to evenly spaced points, among n_from evenly spaced points over the 
+        same span, and the weight w of hi, so values interpolate as 
+        (1 - w)*v[lo] + w*v[hi]'''
+        pos = np.linspace(0.0, n_from - 1, n_to)
+        lo = np.minimum(np.floor(pos), max(n_from - 2, 0)).astype(np.intp)
+        hi = np.minimum(lo + 1, n_from - 1)
+        w = pos - lo
+        for a in (lo, hi, w): # shared by later calls
+            a.flags.writeable = False
+        return lo, hi, w
+
+    @staticmethod
+    def trace_nodes(parents, source, target):
+        '''Follow the parent pointers back from target to source and return
+        the nodes of the path, from source to target'''
+        nodes = [target]
+        while nodes[-1] != source:
+            nodes.append(parents[nodes[-1]])
+        nodes.reverse()
+        return nodes
+
+    @classmethod
+    def trace_path(cls, parents, source, target, ny):
+        '''Follow the parent pointers back from target to source and return
+        the path as a flat list of grid indices [i0, j0, i1, j1, ...]'''
+        return [int(k) for node in cls.trace_nodes(parents, source, target) 
+                for k in divmod(int(node), ny)]
+
+    def neighbor_slices(self, nx, ny):
+        '''Yield each direction n along with the slices of the grid points that
+        have a neighbor in direction n and of those neighbors'''
+        for n, (di, dj) in enumerate(self.neighbor_offsets):
+            src = (slice(max(0,-di), nx - max(0,di)), 
+                    slice(max(0,-dj), ny - max(0,dj)))
+            dst = (slice(max(0,di), nx - max(0,-di)), 
+                    slice(max(0,dj), ny - max(0,-dj)))
+            yield n, src, dst
+
+    def get_blocked_edges(self, nx, ny, window):
+        '''Get the directions that leave the window (i_min, i_max, j_min, 
+        j_max) from each grid point on its border, keyed by flat node index'''
+        blocked = {}
+        if window is None:
+            return blocked
+        i_min, i_max, j_min, j_max = window
+        for i in range(i_min, i_max + 1):
+            for j in (range(j_min, j_max + 1) if i in (i_min, i_max) else 
+                    (j_min, j_max)):
+                directions = [n for n, (di, dj) in 
+                        enumerate(self.neighbor_offsets) 
+                        if not (i_min <= i + di <= i_max and 
+                            j_min <= j + dj <= j_max)]
+                if len(directions) > 0:
+                    blocked[i*ny + j] = directions
+        return blocked
+
+    @staticmethod
+    def get_grid_position(lat, long, lat_long_bbox, nx, ny):
+        '''Get the fractional grid indices (x, y) of a lat/long, which round
+        to the indices from get_grid_indices'''
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        x = nx * (long-long_min) / (long_max-long_min)
+        y = ny - ny * (lat-lat_min) / (lat_max-lat_min) - 1
+        return x, y
+
+    @staticmethod
+    def get_lat_long(x, y, lat_long_bbox, nx, ny):
+        '''Get the lat/long of fractional grid indices (x, y)'''
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        lat = lat_min + (ny - 1 - y) * (lat_max-lat_min) / ny
+        long = long_min + x * (long_max-long_min) / nx
+        return lat, long
+
+    @staticmethod
+    def get_grid_indices(lat, long, lat_long_bbox, nx, ny):
+        '''Get the indices (i, j) of the grid point nearest to a lat/long'''
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        i = int(round(nx * (long-long_min) / (long_max-long_min)))
+        j = ny - int(round(ny * (lat-lat_min) / (lat_max-lat_min))) - 1
+        return i, j
+
     def check_start_end_validity(self, lat_start, long_start, lat_end, long_end, 
             lat_long_bbox, is_land):
         '''Check if start and end points are valid, i.e. not in water'''
-        lat_min, long_min, lat_max, long_max = lat_long_bbox
         nx = is_land.shape[0]
         ny = is_land.shape[1]
-        si = int(round(nx * (long_start-long_min) / (long_max-long_min)))
-        sj = ny - int(round(ny * (lat_start-lat_min) / (lat_max-lat_min))) - 1
-        ei = int(round(nx * (long_end-long_min) / (long_max-long_min)))
-        ej = ny - int(round(ny * (lat_end-lat_min) / (lat_max-lat_min))) - 1
+        si, sj = self.get_grid_indices(lat_start, long_start, lat_long_bbox, 
+                nx, ny)
+        ei, ej = self.get_grid_indices(lat_end, long_end, lat_long_bbox, nx, ny)
 
         if not is_land[si,sj]:
             return si, sj, ei, ej, PathFinderResult.INVALID_START
@@ -180,205 +553,540 @@ class PathFinder:
 
 class Dijkstra(PathFinder):
     
-    def get_optimal_path(self, lat_start, long_start, lat_end, long_end, 
-            lat_long_bbox, lat_dist, long_dist, nx, ny, elev2d, 
-            map_server : MapData):
-        # find the valid grid points and compute the time between neighbors
-        is_land = self.get_land_grid(lat_long_bbox, nx, ny, map_server)
-        neighbor_times = self.compute_neighbor_times(is_land, elev2d, 
-                lat_dist, long_dist)
-       
-        # check if start/end points are valid
-        si, sj, ei, ej, valid = self.check_start_end_validity(lat_start, 
-                long_start, lat_end, long_end, lat_long_bbox, is_land)
-        if (valid == PathFinderResult.INVALID_START or 
-                valid == PathFinderResult.INVALID_END):
-            return valid, []
+    def find_path(self, neighbor_times, source, target, dx, dy, window=None):
+        nx, ny = neighbor_times.shape[0], neighbor_times.shape[1]
+        times, parents = self.search(neighbor_times, source, target, 
+                blocked=self.get_blocked_edges(nx, ny, window))
+        
+        # check if we reached the end node
+        if np.isinf(times[target]):
+            return PathFinderResult.NO_VALID_PATH, []
+
+        return PathFinderResult.OK, self.trace_path(parents, source, target, ny)
+
+    def find_paths(self, neighbor_times, source, targets, dx, dy):
+        '''Find the paths from source to all the targets with one search, 
+        which stops once every target is settled'''
+        ny = neighbor_times.shape[1]
+        times, parents = self.search(neighbor_times, source, targets=targets)
+        return [(PathFinderResult.NO_VALID_PATH, []) if np.isinf(times[target])
+                else (PathFinderResult.OK, self.trace_path(parents, source, 
+                    target, ny)) for target in targets]
+
+    def get_travel_times(self, lat_start, long_start, lat_long_bbox, lat_dist, 
+            long_dist, nx, ny, elev2d, map_server : MapData, max_time=math.inf,
+            is_land=None):
+        '''Determine the travel time from a start point to every grid point 
+        that can be reached within max_time seconds, with one search
+
+        Returns the result, the (nx, ny) travel times (inf for points that 
+        can't be reached in time) and the parent of each flat node index
+        '''
+        is_land, neighbor_times = self.get_graph(lat_long_bbox, lat_dist, 
+                long_dist, nx, ny, elev2d, map_server, is_land)
+        si, sj = self.get_grid_indices(lat_start, long_start, lat_long_bbox, 
+                nx, ny)
+        if not (0 <= si < nx and 0 <= sj < ny and is_land[si,sj]):
+            return PathFinderResult.INVALID_START, None, None
+
+        with self.timings.stage('search'):
+            times, parents = self.search(neighbor_times, si*ny + sj, 
+                    max_time=max_time)
+        return PathFinderResult.OK, times.reshape(nx, ny), parents
+
+    def search(self, neighbor_times, source, target=None, max_time=math.inf,
+            blocked=None, targets=None, neighbors=None):
+        '''Run Dijkstra's algorithm from the flat node index source (i*ny + j)
+        until target, or every node in targets, is reached, or until all 
+        nodes reachable within max_time are settled if neither is given, 
+        without following the directions in blocked (see get_blocked_edges)
+
+        For a graph of nodes that don't make up a whole grid, neighbor_times
+        holds the (n, 8) times from each node to its neighbors, whose node 
+        indices are given in the (n, 8) array neighbors.
+
+        Returns the travel time to each node (inf if it is further than 
+        max_time) and the parent of each node (-1 if it has none)
+        '''
+        edge_times = neighbor_times.reshape(-1, 8)
+        num_nodes = len(edge_times)
+        if neighbors is None:
+            ny = neighbor_times.shape[1]
+            offsets = [di*ny + dj for di,dj in self.neighbor_offsets]
+        else:
+            node_offsets = neighbors - np.arange(num_nodes)[:,np.newaxis]
+        if blocked is None:
+            blocked = {}
+        remaining = set() if targets is None else set(targets)
+        if target is not None:
+            remaining.add(target)
+        stop_early = len(remaining) > 0
 
-        # initialize the parents, keys, etc.
-        pq = PriorityQueue()
-        parents = np.empty((nx,ny), dtype=object) # initialized to None
-        queue_keys = np.empty((nx,ny), dtype=object) # initialized to None
-
-        # insert the start point into the priority queue
-        queue_keys[si,sj] = NodeTimePair(np.array([si,sj]), 0.0)
-        pq.insert(queue_keys[si,sj])
-
-        delta_ij = np.array([[0,1], [1,1], [1,0], [1,-1], [0,-1], [-1,-1], [-1,0], [-1,1]])
-        num_visited = 0
-        found_end = False
-        while len(pq) > 0:
-            node_key = pq.extract_min()
-            node, time = node_key.node, node_key.time
-            i,j = node[0],node[1]
+        # initialize the times and parents, stored by flat node index
+        times = np.full(num_nodes, np.inf)
+        parents = np.full(num_nodes, -1, dtype=np.int32)
+
+        # the heap holds (time, node) entries; entries made stale by a later 
+        # decrease in a node's time are skipped when they are popped
+        times[source] = 0.0
+        heap = [(0.0, source)]
+        num_visited = num_pushes = num_decrease_keys = 0
+        inf = math.inf
+        progress, progress_interval = self.progress, self.progress_interval
+        while heap:
+            time, node = heapq.heappop(heap)
+            if time > times[node]:
+                continue
+            # every node left is further than the time budget
+            if time > max_time:
+                break
             num_visited = num_visited + 1
-           
-            # stop searching if you find the ending node 
-            if (i,j) == (ei,ej):
-                found_end = True
+            if progress is not None and num_visited % progress_interval == 0:
+                progress(times)
+
+            # stop searching once you find all the ending nodes
+            if stop_early and node in remaining:
+                remaining.discard(node)
+                if len(remaining) == 0:
+                    break
+
+            # relax nodes adjacent to this node, skipping unreachable ones
+            edges = edge_times[node].tolist()
+            if neighbors is not None:
+                offsets = node_offsets[node].tolist()
+            for n in blocked.get(node, ()):
+                edges[n] = inf
+            for n, edge_time in enumerate(edges):
+                if edge_time == inf:
+                    continue
+                neigh = node + offsets[n]
+                neigh_time = time + edge_time
+                old_time = times[neigh]
+                if neigh_time < old_time:
+                    num_pushes = num_pushes + 1
+                    if old_time != inf:
+                        num_decrease_keys = num_decrease_keys + 1
+                    times[neigh] = neigh_time
+                    parents[neigh] = node
+                    heapq.heappush(heap, (neigh_time, neigh))
+        times[times > max_time] = np.inf
+
+        self.num_visited = num_visited
+        self.num_pushes = num_pushes
+        self.num_decrease_keys = num_decrease_keys
+        return times, parents
+
+class BidirectionalDijkstra(PathFinder):
+    
+    def find_path(self, neighbor_times, source, target, dx, dy, window=None):
+        '''Perform Dijkstra from start and end points, expanding the direction
+        with fewer frontier nodes, until the searches meet'''
+        nx, ny = neighbor_times.shape[0], neighbor_times.shape[1]
+        if source == target:
+            self.num_visited = 1
+            self.num_pushes = self.num_decrease_keys = 0
+            return PathFinderResult.OK, self.trace_path([], source, target, ny)
+
+        # walking times are asymmetric, so the reverse search has to follow 
+        # each edge from its end point back to its start point
+        edge_times = (neighbor_times.reshape(nx*ny, 8), 
+                self.reverse_neighbor_times(neighbor_times, 
+                    window).reshape(nx*ny, 8))
+        offsets = [di*ny + dj for di,dj in self.neighbor_offsets]
+        blocked = self.get_blocked_edges(nx, ny, window)
+
+        # initialize the times and parents in both forward and reverse 
+        # directions, stored by flat node index
+        times = (np.full(nx*ny, np.inf), np.full(nx*ny, np.inf))
+        parents = (np.full(nx*ny, -1, dtype=np.int32), 
+                np.full(nx*ny, -1, dtype=np.int32))
+        times[0][source] = 0.0
+        times[1][target] = 0.0
+        frontiers = ([(0.0, source)], [(0.0, target)])
+
+        # min_total_time is the time of the best path found through a node 
+        # reached by both searches, and meet_node is that node
+        min_total_time = np.inf
+        meet_node = -1
+        num_visited = num_pushes = num_decrease_keys = 0
+        inf = math.inf
+        progress, progress_interval = self.progress, self.progress_interval
+        while len(frontiers[0]) > 0 and len(frontiers[1]) > 0:
+            # no undiscovered path can be shorter than the sum of the 
+            # smallest times in the frontiers 
+            if frontiers[0][0][0] + frontiers[1][0][0] >= min_total_time:
                 break
-            
-            # relax nodes adjacent to this node
-            for n in range(8):
-                # skip nodes that aren't reachable
-                if np.isinf(neighbor_times[i,j,n]):
+
+            # choose search direction
+            search_dir = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            frontier = frontiers[search_dir]
+            dir_times, dir_parents = times[search_dir], parents[search_dir]
+            other_times = times[1 - search_dir]
+
+            time, node = heapq.heappop(frontier)
+            if time > dir_times[node]:
+                continue
+            num_visited = num_visited + 1
+            if progress is not None and num_visited % progress_interval == 0:
+                progress(np.minimum(times[0], times[1]))
+
+            # relax nodes adjacent to this node, skipping unreachable ones
+            edges = edge_times[search_dir][node].tolist()
+            for n in blocked.get(node, ()):
+                edges[n] = inf
+            for n, edge_time in enumerate(edges):
+                if edge_time == inf:
                     continue
-                neigh_ij = node + delta_ij[n]
-                ni,nj = neigh_ij[0],neigh_ij[1]
-                neigh_time = neighbor_times[i,j,n] + time
-                if queue_keys[ni, nj] is None:
-                    queue_keys[ni,nj] = NodeTimePair(np.array([ni,nj]), 
-                        neigh_time)
-                    pq.insert(queue_keys[ni,nj])
-                    parents[ni,nj] = np.array([i,j])
-                elif neigh_time < queue_keys[ni,nj].time:
-                    queue_keys[ni,nj].time = neigh_time
-                    pq.decrease_key(queue_keys[ni,nj])
-                    parents[ni,nj] = np.array([i,j])
+                neigh = node + offsets[n]
+                neigh_time = time + edge_time
+                old_time = dir_times[neigh]
+                if neigh_time < old_time:
+                    num_pushes = num_pushes + 1
+                    if old_time != inf:
+                        num_decrease_keys = num_decrease_keys + 1
+                    dir_times[neigh] = neigh_time
+                    dir_parents[neigh] = node
+                    heapq.heappush(frontier, (neigh_time, neigh))
+
+                    # check if the other search has reached this node
+                    total_time = neigh_time + other_times[neigh]
+                    if total_time < min_total_time:
+                        min_total_time = total_time
+                        meet_node = neigh
+        self.num_visited = num_visited
+        self.num_pushes = num_pushes
+        self.num_decrease_keys = num_decrease_keys
+
+        # check if the searches met
+        if meet_node < 0:
+            return PathFinderResult.NO_VALID_PATH, []
         
+        # stitch the forward path to the meeting node onto the reverse path
+        path = self.trace_path(parents[0], source, meet_node, ny)
+        node = meet_node
+        while node != target:
+            node = parents[1][node]
+            path.extend(divmod(int(node), ny))
+        return PathFinderResult.OK, path
+
+    def reverse_neighbor_times(self, neighbor_times, window=None):
+        '''Compute the travel time from each grid point's 8 neighbors to the 
+        grid point, in the same ordering as neighbor_times, for the grid 
+        points in the window (i_min, i_max, j_min, j_max) if one is given; 
+        the other grid points are left uninitialized'''
+        nx = neighbor_times.shape[0]
+        ny = neighbor_times.shape[1]
+        if window is None:
+            window = (0, nx - 1, 0, ny - 1)
+        i_min, i_max, j_min, j_max = window
+        reverse_times = np.empty((nx,ny,8))
+        window_slices = (slice(i_min, i_max + 1), slice(j_min, j_max + 1))
+        window_times = neighbor_times[window_slices]
+        window_reverse_times = reverse_times[window_slices]
+        window_reverse_times[...] = np.inf
+        for n, src, dst in self.neighbor_slices(i_max - i_min + 1, 
+                j_max - j_min + 1):
+            # the edge back from the neighbor in direction n is in the 
+            # opposite direction
+            window_reverse_times[src + (n,)] = window_times[dst + ((n+4)%8,)]
+        return reverse_times
+
+class AStar(PathFinder):
+
+    def find_path(self, neighbor_times, source, target, dx, dy, window=None):
+        '''Perform A* search, using the time to walk the straight line to the 
+        end point at the maximum walking speed as the heuristic'''
+        nx, ny = neighbor_times.shape[0], neighbor_times.shape[1]
+        edge_times = neighbor_times.reshape(nx*ny, 8)
+        offsets = [di*ny + dj for di,dj in self.neighbor_offsets]
+        blocked = self.get_blocked_edges(nx, ny, window)
+        heuristic = self.heuristic_times(nx, ny, target, dx, dy)
+
+        # initialize the times and parents, stored by flat node index
+        times = np.full(nx*ny, np.inf)
+        parents = np.full(nx*ny, -1, dtype=np.int32)
+
+        # the heap holds (estimated total time, time, node) entries; entries
+        # made stale by a later decrease in a node's time are skipped
+        times[source] = 0.0
+        heap = [(heuristic[source], 0.0, source)]
+        num_visited = num_pushes = num_decrease_keys = 0
+        inf = math.inf
+        progress, progress_interval = self.progress, self.progress_interval
+        while heap:
+            _, time, node = heapq.heappop(heap)
+            if time > times[node]:
+                continue
+            num_visited = num_visited + 1
+            if progress is not None and num_visited % progress_interval == 0:
+                progress(times)
+
+            # stop searching if you find the ending node
+            if node == target:
+                break
+
+            # relax nodes adjacent to this node, skipping unreachable ones
+            edges = edge_times[node].tolist()
+            for n in blocked.get(node, ()):
+                edges[n] = inf
+            for n, edge_time in enumerate(edges):
+                if edge_time == inf:
+                    continue
+                neigh = node + offsets[n]
+                neigh_time = time + edge_time
+                old_time = times[neigh]
+                if neigh_time < old_time:
+                    num_pushes = num_pushes + 1
+                    if old_time != inf:
+                        num_decrease_keys = num_decrease_keys + 1
+                    times[neigh] = neigh_time
+                    parents[neigh] = node
+                    heapq.heappush(heap, (neigh_time + heuristic[neigh], 
+                        neigh_time, neigh))
+        self.num_visited = num_visited
+        self.num_pushes = num_pushes
+        self.num_decrease_keys = num_decrease_keys
+
         # check if we reached the end node
-        if not found_end:
+        if np.isinf(times[target]):
             return PathFinderResult.NO_VALID_PATH, []
 
-        # follow the parent pointers back to build the path
-        path = [int(ej),int(ei)]
-        i,j = ei,ej
-        while (i,j) != (si,sj):
-            parent = parents[i,j]
-            i,j = parent[0], parent[1]
-            path.append(int(j))
-            path.append(int(i))
-        path.reverse()
-        return PathFinderResult.OK, path
+        return PathFinderResult.OK, self.trace_path(parents, source, target, ny)
+
+    def heuristic_times(self, nx, ny, target, dx, dy):
+        '''Compute a lower bound on the travel time from each node to the 
+        target, which never overestimates since no edge can be walked faster 
+        than max_speed'''
+        ei, ej = divmod(target, ny)
+        x = dx * np.abs(np.arange(nx) - ei)
+        y = dy * np.abs(np.arange(ny) - ej)
+        return (np.hypot(x[:,None], y[None,:]) / self.max_speed).ravel()
+
+class MultiResolutionDijkstra(Dijkstra):
+    '''Dijkstra search on the given grid, followed by searches on grids that 
+    are factor times finer at each level, restricted to a corridor around the
+    path found on the level before
+
+    Each level only computes the neighbor times of the fine grid points in
+    its corridor, and searches them as a graph of their own, so its cost 
+    grows with the length of the corridor rather than with its bbox. The 
+    elevations of the corridor are fetched from elev_server, in blocks of 
+    fetch_block x fetch_block fine grid points, or else interpolated from 
+    the given grid. Water is taken from the given land grid. Refining stops
+    at a level whose corridor has more than max_corridor_points points.
+    '''
+    max_corridor_points = 500000
+    corridor_block = 1024 # path points whose corridor is gathered at a time
+    fetch_block = 32
+    fetch_threads = 8
+
+    def __init__(self, land_mask_cache : LandMaskCache = None, 
+            timings : StageTimings = None, elev_server=None, factor=4, 
+            num_levels=2, corridor=3, land_majority=False):
+        super().__init__(land_mask_cache, timings, 
+                land_majority=land_majority)
+        self.elev_server = elev_server
+        self.factor = factor
+        self.num_levels = num_levels # levels finer than the given grid
+        self.corridor = corridor # corridor half width, in coarser grid cells
 
-class BidirectionalDijkstra(PathFinder):
-    
     def get_optimal_path(self, lat_start, long_start, lat_end, long_end, 
             lat_long_bbox, lat_dist, long_dist, nx, ny, elev2d, 
-            map_server : MapData):
-        # find the valid grid points and compute the time between neighbors
-        is_land = self.get_land_grid(lat_long_bbox, nx, ny, map_server)
-        neighbor_times = self.compute_neighbor_times(is_land, elev2d, 
-                lat_dist, long_dist)
-       
-        # check if start/end points are valid
-        valid = self.check_start_end_validity(lat_start, long_start, lat_end, 
-            long_end, lat_long_bbox, is_land)
-        if (valid == PathFinderResult.INVALID_START or 
-                valid == PathFinderResult.INVALID_END):
-            return valid, []
-        
-        '''Perform Dijkstra from start and end points
-        Choose direction with fewer frontier nodes for expansion'''
-        fwd_frontier = PriorityQueue()
-        rev_frontier = PriorityQueue()
-
-        # initialize the parents, keys, etc. in both forward and reverse directions
-        parents = np.empty((nx,ny,2), dtype=object) # initialized to None
-        queue_keys = np.empty((nx,ny,2), dtype=object) # initialized to None
-        finalized = np.zeros((nx,ny,2), dtype=bool) # initialized to False
-
-        # insert the start and end points into the priority queues
-        queue_keys[si,sj,0] = NodeTimePair(np.array([si,sj]), 0.0)
-        fwd_frontier.insert(queue_keys[si,sj,0])
-        queue_keys[ei,ej,1] = NodeTimePair(np.array([ei,ej]), 0.0)
-        rev_frontier.insert(queue_keys[ei,ej,1])
+            map_server : MapData, is_land=None, graph_name=None):
+        '''Determine the optimal path between two points, returning the path
+        in fractional grid indices of the given grid'''
+        if is_land is None:
+            is_land = self.get_land_grid(lat_long_bbox, nx, ny, map_server)
+        result, path = super().get_optimal_path(lat_start, long_start, 
+                lat_end, long_end, lat_long_bbox, lat_dist, long_dist, nx, ny,
+                elev2d, map_server, is_land, graph_name)
+        if result != PathFinderResult.OK:
+            return result, path
+        counts = [self.num_visited, self.num_pushes, self.num_decrease_keys]
 
-        '''
-        for node in nodes:
-            node.parent = None
-            node.queue_key = None
-            
-        num_visited = 0
-    
-        # Run Dijkstra's algorithm.
-        pq = PriorityQueue()
-        # Use NodeTimePair as a key in the priority queue.
-        source.queue_key = NodeTimePair(source, 0)
-        pq.insert(source.queue_key)
-        
-        while len(pq) > 0:
-            node_key = pq.extract_min()
-            node, dist = node_key.node, node_key.distance
-            num_visited = num_visited + 1
-            if node is destination: break
-            for next_node in node.adj: # Relax nodes adjacent to node.
-                next_dist = weight(node, next_node) + dist
-                if next_node.queue_key is None:
-                    next_node.queue_key = NodeTimePair(next_node, next_dist)
-                    pq.insert(next_node.queue_key)
-                    next_node.parent = node
-                elif next_dist < next_node.queue_key.distance:
-                    next_node.queue_key.distance = next_dist
-                    pq.decrease_key(next_node.queue_key)
-                    next_node.parent = node
-        
-      FFinalized:
-      FReachable: fwd_frontier
-      FCost = min_times[0]
-
-      node(G) fnext = FReachable.getMinKey();
-      FReachable.remove(fnext);
-      fnext.FFinalized = true;
-      curMinFCost = fnext.FCost;
-      if (curMinFCost + curMinRCost + minUnitCost >= minCost) {
-        terminate = true;
-      }
-
-      double fdist = fnext.FCost;
-      for(v: fnext.nbrs) (!v.FFinalized) {
-        edge e = v.edge();
-        if (fdist + e.Weight + curMinRCost <= minCost) {
-          if (v.FCost > fdist + e.Weight) {
-            v.FCost = fdist + e.Weight;
-            FReachable[v] = v.FCost;
-            v.Parent = fnext;
-            v.ParentEdge = e;
-            if (v.RCost != +INF) {
-              double newCost = v.FCost + v.RCost;
-              <minCost; mid> min= <newCost; v>;
-            }
-          }
-        }
-      }
+        # grid indices of the start and end points, before rounding
+        ends = np.array([self.get_grid_position(lat, long, lat_long_bbox, nx,
+            ny) for lat, long in ((lat_start, long_start), (lat_end, long_end))])
 
-        '''
+        path = np.array(path, dtype=float).reshape(-1, 2)
+        scale = 1
+        for level in range(self.num_levels):
+            scale *= self.factor
+            fine_path = self.refine_path(path, ends, scale, lat_long_bbox, 
+                    lat_dist, long_dist, nx, ny, elev2d, is_land)
+            counts = [c + n for c, n in zip(counts, (self.num_visited, 
+                self.num_pushes, self.num_decrease_keys))]
+            if fine_path is None:
+                break
+            path = fine_path
+        self.num_visited, self.num_pushes, self.num_decrease_keys = counts
+        return PathFinderResult.OK, path.ravel().tolist()
 
-        terminate = False
-        min_times = [np.inf,np.inf]
-        min_total_time = np.inf
-        # ordering is (N, NE, E, SE, S, SW, W, NW)
-        delta_ij = np.array([[0,1], [1,1], [1,0], [1,-1], [0,-1], [-1,-1], [-1,0], [-1,1]])
-        while (not terminate) and len(fwd_frontier) > 0 and len(rev_frontier) > 0:
-            # choose search direction 
-            if len(fwd_frontier) < len(rev_frontier):
-                frontier = fwd_frontier
-                search_dir = 0
-            else:
-                frontier = rev_frontier
-                search_dir = 1
+    def get_optimal_paths(self, legs, lat_long_bbox, lat_dist, long_dist, 
+            nx, ny, elev2d, map_server : MapData, is_land=None, 
+            graph_name=None):
+        '''Determine the optimal paths of many legs, sharing the land grid, 
+        with a search and refinement for each leg'''
+        if is_land is None:
+            is_land = self.get_land_grid(lat_long_bbox, nx, ny, map_server)
+        results = []
+        counts = [0, 0, 0]
+        for lat_start, long_start, lat_end, long_end in legs:
+            si, sj = self.get_grid_indices(lat_start, long_start, 
+                    lat_long_bbox, nx, ny)
+            ei, ej = self.get_grid_indices(lat_end, long_end, lat_long_bbox, 
+                    nx, ny)
+            if not (0 <= si < nx and 0 <= sj < ny):
+                results.append((PathFinderResult.INVALID_START, []))
+                continue
+            if not (0 <= ei < nx and 0 <= ej < ny):
+                results.append((PathFinderResult.INVALID_END, []))
+                continue
+            self.num_visited = self.num_pushes = self.num_decrease_keys = 0
+            results.append(self.get_optimal_path(lat_start, long_start, 
+                lat_end, long_end, lat_long_bbox, lat_dist, long_dist, nx, ny,
+                elev2d, map_server, is_land))
+            counts = [c + n for c, n in zip(counts, (self.num_visited, 
+                self.num_pushes, self.num_decrease_keys))]
+        self.num_visited, self.num_pushes, self.num_decrease_keys = counts
+        return results
+
+    def refine_path(self, path, ends, scale, lat_long_bbox, lat_dist, 
+            long_dist, nx, ny, elev2d, is_land):
+        '''Search for the path between the start and end points on a grid 
+        scale times finer than the given grid, within the corridor around 
+        path (an array of fractional grid indices of the given grid)
 
-            node_and_key = frontier.extract_min()
-            node, time = node_and_key.node, node_and_key.time
-            min_times[search_dir] = time
+        Returns the finer path in fractional grid indices of the given grid, 
+        or None if the corridor doesn't hold a valid path or is too big
+        '''
+        self.num_visited = self.num_pushes = self.num_decrease_keys = 0
+        nx_fine, ny_fine = (nx - 1) * scale + 1, (ny - 1) * scale + 1
+        nodes = self.get_corridor(path, scale, nx_fine, ny_fine)
+        if nodes is None:
+            return None
+        fine_i, fine_j = np.divmod(nodes, ny_fine)
 
-            # check if any nodes have been found by both searches
-            if min_times[0] + min_times[1] >= min_total_time:
-                terminate = True
+        # take water from the given grid, and the elevations from the 
+        # elevation server or else interpolated from the given grid
+        is_land_fine = is_land[np.rint(fine_i / scale).astype(int), 
+                np.rint(fine_j / scale).astype(int)]
+        if self.elev_server is not None:
+            elev = self.fetch_elevations(lat_long_bbox, nx, ny, fine_i, fine_j,
+                    scale)
+        else:
+            with self.timings.stage('interpolation'):
+                elev = ndimage.map_coordinates(np.asarray(elev2d, dtype=float),
+                        (fine_i / scale, fine_j / scale), order=1)
+        dx = long_dist / nx / scale
+        dy = lat_dist / ny / scale
+        with self.timings.stage('edge_costs'):
+            neighbors, neighbor_times = self.compute_corridor_times(nodes, 
+                    ny_fine, is_land_fine, elev, dx, dy)
 
-            # relax nodes adjacent to this node
-            for n in range(8):
-                # skip nodes that aren't reachable
-                if np.isinf(neighbor_times[node[0], node[1], n]):
-                    continue
+        # search between the corridor points nearest the start and end
+        ends_fine = np.clip(np.rint(ends * scale).astype(np.int64), 0, 
+                [nx_fine - 1, ny_fine - 1])
+        keys = ends_fine[:,0] * ny_fine + ends_fine[:,1]
+        source, target = np.minimum(np.searchsorted(nodes, keys), 
+                len(nodes) - 1).tolist()
+        if not (np.array_equal(nodes[[source, target]], keys) and 
+                is_land_fine[source] and is_land_fine[target]):
+            return None
+        with self.timings.stage('search'):
+            times, parents = self.search(neighbor_times, source, target, 
+                    neighbors=neighbors)
+        if np.isinf(times[target]):
+            return None
+        fine_path = nodes[self.trace_nodes(parents, source, target)]
+        return np.column_stack(np.divmod(fine_path, ny_fine)) / scale
 
-                # skip nodes that have been finalized
-                # TODO
+    def get_corridor(self, path, scale, nx_fine, ny_fine):
+        '''Get the sorted flat indices (i*ny_fine + j) of the points of the 
+        fine grid within the corridor around path, by their distance from the
+        path with a point at each step of the coarser grid it was found on, 
+        or None if there are more than max_corridor_points'''
+        along = np.linspace(0.0, len(path) - 1, 
+                (len(path) - 1) * self.factor + 1)
+        path_i, path_j = [np.rint(np.interp(along, np.arange(len(path)), 
+            path[:,k]) * scale).astype(np.int64) for k in range(2)]
+        path_i, path_j = np.divmod(np.unique(path_i * ny_fine + path_j), 
+                ny_fine)
 
-                i,j = node[0],node[1]
-                neigh_ij = node + delta_ij[n] 
-                neigh_time = neighbor_times[i,j,n]
+        # gather the points within the corridor half width of a block of 
+        # path points at a time
+        r = self.corridor * self.factor
+        di, dj = np.mgrid[-r:r+1, -r:r+1]
+        disk = di**2 + dj**2 <= r**2
+        di, dj = di[disk], dj[disk]
+        blocks = []
+        for start in range(0, len(path_i), self.corridor_block):
+            i = path_i[start:start + self.corridor_block, np.newaxis] + di
+            j = path_j[start:start + self.corridor_block, np.newaxis] + dj
+            inside = (i >= 0) & (i < nx_fine) & (j >= 0) & (j < ny_fine)
+            blocks.append(np.unique(i[inside] * ny_fine + j[inside]))
+        nodes = np.unique(np.concatenate(blocks))
+        if len(nodes) > self.max_corridor_points:
+            return None
+        return nodes
 
+    def compute_corridor_times(self, nodes, ny, is_land, elev, dx, dy):
+        '''Compute the travel time between each point of a corridor, given by
+        their sorted flat indices (i*ny + j), and its 8 neighbors, returning 
+        the (n, 8) corridor indices of the neighbors (-1 for those outside 
+        the corridor) and the (n, 8) travel times'''
+        heights = np.where(is_land & np.isfinite(elev), elev, np.inf)
+        j = nodes % ny
+        dxy = math.sqrt(dx**2 + dy**2)
+        dists = (dy, dxy, dx, dxy, dy, dxy, dx, dxy)
+        neighbors = np.full((len(nodes), 8), -1, dtype=np.int32)
+        neighbor_times = np.full((len(nodes), 8), np.inf)
+        for n, (di, dj) in enumerate(self.neighbor_offsets):
+            keys = nodes + di*ny + dj
+            k = np.minimum(np.searchsorted(nodes, keys), len(nodes) - 1)
+            found = (nodes[k] == keys) & (j + dj >= 0) & (j + dj < ny)
+            neighbors[found, n] = k[found]
+            neighbor_times[found, n] = self.walking_times(heights[found], 
+                    heights[k[found]], dists[n])
+        return neighbors, neighbor_times
 
+    def fetch_elevations(self, lat_long_bbox, nx, ny, fine_i, fine_j, scale):
+        '''Fetch the elevations of points of a grid scale times finer than 
+        the given grid, by their fine grid indices, with a request for each 
+        run of fetch_block x fetch_block blocks along a row of blocks that 
+        holds any of the points'''
+        lat_min, long_min, lat_max, long_max = lat_long_bbox
+        dlat = (lat_max - lat_min) / ny / scale
+        dlong = ((long_max - long_min) % 360.0) / nx / scale
+        B = self.fetch_block
+        num_blocks_i = int(fine_i.max()) // B + 1
+        blocks = (fine_j // B) * num_blocks_i + fine_i // B
+        order = np.argsort(blocks, kind='stable')
+        sorted_blocks = blocks[order]
+        used = np.unique(sorted_blocks)
+        runs = np.split(used, np.flatnonzero((np.diff(used) != 1) | 
+            (np.diff(used // num_blocks_i) != 0)) + 1)
 
+        def fetch_run(run):
+            block_j, block_i = divmod(int(run[0]), num_blocks_i)
+            i0, j0 = block_i * B, block_j * B
+            run_nx = min(int(run[-1]) % num_blocks_i * B + B, 
+                    int(fine_i.max()) + 1) - i0
+            run_ny = min(B, int(fine_j.max()) + 1 - j0)
+            window_lat_max = lat_max - j0*dlat
+            window_long_min = long_min + i0*dlong
+            window_bbox = (window_lat_max - run_ny*dlat, 
+                    ElevationData.clip_long(window_long_min), window_lat_max, 
+                    ElevationData.clip_long(window_long_min + run_nx*dlong))
+            window = np.reshape(np.array(self.elev_server.get_elevations(
+                window_bbox, run_nx, run_ny), dtype=float), (run_ny, run_nx)).T
+            points = order[np.searchsorted(sorted_blocks, run[0]):
+                    np.searchsorted(sorted_blocks, run[-1], side='right')]
+            return points, window[fine_i[points] - i0, fine_j[points] - j0]
 
+        elev = np.empty(len(fine_i))
+        with self.timings.stage('elevation_fetch'):
+            with ThreadPoolExecutor(self.fetch_threads) as executor:
+                for points, values in executor.map(fetch_run, runs):
+                    elev[points] = values
+        return elev
@@ -0,0 +1,55 @@
+'''Compact binary encoding of a route result, used instead of JSON when the
+client asks for format=binary.
+
+Layout (little-endian):
+    uint32      length of the JSON header in bytes
+    bytes       JSON header, padded with spaces to a multiple of 4 bytes
+    int16[ny*nx] elevations, quantized and delta-encoded along each row
+    float32[]   path, as flat grid indices [i0, j0, i1, j1, ...], which may be
+                fractional for paths refined on finer grids
+
+The header holds all the other result fields, plus elev_scale and
+elev_offset so that elev = elev_offset + elev_scale*q, where q is the
+running sum of the deltas along each row (wrapping like int16). Delta
+encoding makes smooth terrain compress well when the payload is gzipped.
+'''
+import base64, json, struct
+import numpy as np
+
+def quantize_elevations(elev, resolution=0.1):
+    '''Quantize elevations to int16 steps of at least resolution (m), 
+    returning q, scale and offset such that elev = offset + scale*q; missing 
+    (nan) elevations become the lowest elevation'''
+    elev = np.asarray(elev, dtype=float)
+    lo, hi = np.nanmin(elev), np.nanmax(elev)
+    if not np.isfinite(lo):
+        lo = hi = 0.0
+    scale = max((hi - lo) / 65534.0, resolution)
+    offset = lo + 32767.0*scale
+    q = np.rint((np.nan_to_num(elev, nan=lo) - offset) / scale)
+    return q.astype(np.int16), scale, offset
+
+def pack_result(header, elev, path, nx, ny):
+    '''Pack the route result fields in header, the ny*nx elevations (ordered
+    north to south, then west to east) and the path into bytes'''
+    q, scale, offset = quantize_elevations(elev)
+    q = q.reshape(ny, nx).astype(np.int32)
+    deltas = np.diff(q, axis=1, prepend=0).astype(np.int16) # wraps like int16
+
+    header = dict(header, elev_scale=scale, elev_offset=offset,
+            path_length=len(path))
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 4)
+    elev_bytes = deltas.astype('<i2').tobytes()
+    elev_bytes += b'\0' * (-len(elev_bytes) % 4)
+    return (struct.pack('<I', len(header_bytes)) + header_bytes + elev_bytes +
+            np.asarray(path, dtype='<f4').tobytes())
+
+def encode_times(times, max_time):
+    '''Encode travel times (s) as base64 uint16 steps of scale seconds, where
+    times past max_time (or inf) become 65535, ordered like the elevations;
+    returns the encoded string and scale'''
+    times = np.asarray(times, dtype=float)
+    scale = max(max_time / 65534.0, 1.0)
+    q = np.where(times <= max_time, np.rint(times / scale), 65535.0)
+    return base64.b64encode(q.astype('<u2').tobytes()).decode('ascii'), scale
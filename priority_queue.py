@@ -1,3 +1,5 @@
+from array import array
+
 class PriorityQueue:
     """Min-heap-based priority queue, using 1-based indexing. Adapted from CLRS.
     
@@ -90,3 +92,122 @@ class PriorityQueue:
         for key, index in self.key_index.items():
             if self.heap[index] is not key:
                 raise ValueError('Key index mapping is wrong.')
+
+class IndexedPriorityQueue:
+    """Array-based d-ary min-heap of integer ids with float priorities.
+    
+    Ids must lie in range(capacity). The heap stores ids and priorities in
+    preallocated arrays, and a position array maps each id to its index in 
+    the heap (-1 if absent), so decrease_key(id, priority) is O(log n) time
+    without any per-key objects.
+    """
+
+    def __init__(self, capacity, arity=2):
+        """Initializes an empty priority queue for ids 0 to capacity-1."""
+        if arity < 2:
+            raise ValueError('Arity must be at least 2.')
+        self.arity = arity
+        self.size = 0
+        self.ids = array('i', [0]) * capacity
+        self.priorities = array('d', [0.0]) * capacity
+        self.position = array('i', [-1]) * capacity
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, id):
+        return self.position[id] >= 0
+
+    def priority(self, id):
+        """Returns the priority of an id in the priority queue."""
+        return self.priorities[self.position[id]]
+
+    def peek_min(self):
+        """Returns the (id, priority) pair with the minimum priority without
+        removing it."""
+        if self.size < 1:
+            return None
+        return self.ids[0], self.priorities[0]
+
+    def insert(self, id, priority):
+        """Inserts an id with the given priority into the priority queue.
+
+        Raises ValueError if the id is already in the priority queue; use
+        decrease_key to change its priority instead.
+        """
+        if self.position[id] >= 0:
+            raise ValueError('Id {} is already in the queue.'.format(id))
+        self.size += 1
+        self._sift_up(self.size - 1, id, priority)
+
+    def decrease_key(self, id, priority):
+        """Decreases the priority of an id if it is in the priority queue and
+        priority is lower than its current one, maintaining the heap 
+        property."""
+        i = self.position[id]
+        if i >= 0 and priority < self.priorities[i]:
+            self._sift_up(i, id, priority)
+
+    def extract_min(self):
+        """Removes and returns the (id, priority) pair with the minimum 
+        priority."""
+        if self.size < 1:
+            return None
+        ids, priorities = self.ids, self.priorities
+        min_id, min_priority = ids[0], priorities[0]
+        self.position[min_id] = -1
+        self.size -= 1
+        if self.size > 0:
+            self._sift_down(0, ids[self.size], priorities[self.size])
+        return min_id, min_priority
+
+    def _sift_up(self, i, id, priority):
+        """Moves the hole at index i up until id can be placed in it."""
+        ids, priorities, position = self.ids, self.priorities, self.position
+        arity = self.arity
+        while i > 0:
+            parent = (i - 1) // arity
+            if priorities[parent] <= priority:
+                break
+            ids[i] = ids[parent]
+            priorities[i] = priorities[parent]
+            position[ids[i]] = i
+            i = parent
+        ids[i] = id
+        priorities[i] = priority
+        position[id] = i
+
+    def _sift_down(self, i, id, priority):
+        """Moves the hole at index i down until id can be placed in it."""
+        ids, priorities, position = self.ids, self.priorities, self.position
+        arity, size = self.arity, self.size
+        while True:
+            first = arity * i + 1
+            if first >= size:
+                break
+            # find the smallest child
+            smallest = first
+            for c in range(first + 1, min(first + arity, size)):
+                if priorities[c] < priorities[smallest]:
+                    smallest = c
+            if priorities[smallest] >= priority:
+                break
+            ids[i] = ids[smallest]
+            priorities[i] = priorities[smallest]
+            position[ids[i]] = i
+            i = smallest
+        ids[i] = id
+        priorities[i] = priority
+        position[id] = i
+
+    def check_ri(self):
+        for i in range(1, self.size):
+            parent = (i - 1) // self.arity
+            if self.priorities[i] < self.priorities[parent]:
+                raise ValueError('Child is smaller than parent.')
+
+        for i in range(self.size):
+            if self.position[self.ids[i]] != i:
+                raise ValueError('Id position mapping is wrong.')
+        if sum(1 for p in self.position if p >= 0) != self.size:
+            raise ValueError('Id position mapping is wrong.')
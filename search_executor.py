@@ -0,0 +1,213 @@
+import threading, time
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from pathfinder import PathFinder, SearchCancelled
+from metrics import metrics
+
+class SearchQueueFull(Exception):
+    '''Raised when a search is submitted while the job queue is full'''
+    pass
+
+class SearchTimeout(SearchCancelled):
+    '''Raised when a search doesn't finish within its timeout'''
+    pass
+
+class SearchExecutor:
+    '''Runs compute_neighbor_times and the search of PathFinder objects in a
+    pool of processes, so searches use all cores and don't hold the GIL of
+    the web server's processes
+
+    The elevation and land grids are passed to the workers through shared
+    memory, and only the results are sent back. At most max_queued jobs wait
+    for a free worker, and jobs are stopped timeout seconds after they are
+    submitted.
+    '''
+
+    def __init__(self, max_workers=None, max_queued=16, timeout=60.0):
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.executor = self.make_pool()
+        self.slots = threading.BoundedSemaphore(
+                self.executor._max_workers + max_queued)
+
+    def make_pool(self):
+        # start workers with a fresh interpreter, since the fetch schedulers'
+        # threads wouldn't survive a fork
+        return ProcessPoolExecutor(self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, method, pathfinder : PathFinder, args, elev2d, is_land,
+            snapshot_interval=None, **kwargs):
+        '''Start pathfinder.method(*args, elev2d=elev2d, is_land=is_land,
+        **kwargs) in a worker process, where method is get_optimal_path,
+        get_optimal_paths or get_travel_times, and return its SearchJob
+
+        If snapshot_interval is given, the grid points reached by the search
+        are shared with the job every snapshot_interval seconds.
+        '''
+        if not self.slots.acquire(blocking=False):
+            metrics.inc('search_jobs_total', result='rejected')
+            raise SearchQueueFull('too many searches are waiting')
+        blocks = []
+        try:
+            grids = []
+            for grid in (np.asarray(elev2d, dtype=float),
+                    np.asarray(is_land, dtype=bool)):
+                block = shared_memory.SharedMemory(create=True,
+                        size=max(grid.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(grid.shape, grid.dtype, buffer=block.buf)[...] = grid
+                grids.append((block.name, grid.shape, grid.dtype.str))
+
+            # the status block holds a cancel flag, a new snapshot flag and
+            # the snapshot of the grid points reached
+            num_reached = np.size(is_land) if snapshot_interval else 0
+            status = shared_memory.SharedMemory(create=True, 
+                    size=2 + num_reached)
+            status.buf[:2] = b'\0\0'
+            blocks.append(status)
+
+            # replace the pool if a worker died, which breaks it for good
+            if self.executor._broken:
+                self.executor.shutdown(wait=False)
+                self.executor = self.make_pool()
+            deadline = time.time() + self.timeout
+            future = self.executor.submit(run_search, method, pathfinder,
+                    args, kwargs, grids, (status.name, (2 + num_reached,), 
+                        '|b1'), snapshot_interval, deadline)
+        except Exception:
+            self.release(blocks)
+            raise
+        job = SearchJob(pathfinder, future, status, num_reached, deadline)
+        future.add_done_callback(lambda future: job.close(
+            lambda: self.release(blocks)))
+        return job
+
+    def run(self, method, pathfinder : PathFinder, args, elev2d, is_land,
+            **kwargs):
+        '''Run pathfinder.method in a worker process (see submit) and return
+        what it returns'''
+        return self.submit(method, pathfinder, args, elev2d, is_land,
+                **kwargs).result()
+
+    def release(self, blocks):
+        '''Free the shared memory and queue slot of a job that has ended'''
+        for block in blocks:
+            block.close()
+            block.unlink()
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class SearchJob:
+    '''A search running in a worker process, which can be cancelled and
+    followed through snapshots of the grid points it has reached'''
+
+    def __init__(self, pathfinder : PathFinder, future, status, num_reached,
+            deadline):
+        self.pathfinder = pathfinder
+        self.future = future
+        self.status = status
+        self.num_reached = num_reached
+        self.deadline = deadline
+        self.cancelled = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        '''Ask the worker to stop the search'''
+        with self.lock:
+            self.cancelled = True
+            if not self.closed:
+                self.status.buf[0] = 1
+
+    def snapshot(self):
+        '''Get the grid points, by flat node index, reached by the search
+        since the last snapshot was taken, or None if there is no new one'''
+        with self.lock:
+            if self.closed or self.status.buf[1] == 0:
+                return None
+            self.status.buf[1] = 0
+            reached = np.ndarray(self.num_reached, dtype=bool,
+                    buffer=self.status.buf, offset=2).copy()
+        return reached
+
+    def result(self):
+        '''Wait for the search and return what it returned, with the
+        pathfinder's counts and timings updated as though it had run here'''
+        try:
+            value, counts, timings = self.future.result(
+                    timeout=max(self.deadline - time.time(), 0.0) + 1.0)
+        except (TimeoutError, SearchTimeout):
+            self.cancel()
+            metrics.inc('search_jobs_total', result='timeout')
+            raise SearchTimeout('search took longer than the timeout')
+        except SearchCancelled:
+            metrics.inc('search_jobs_total', result='cancelled')
+            raise
+        metrics.inc('search_jobs_total', result='ok')
+        self.pathfinder.num_visited, self.pathfinder.num_pushes, \
+                self.pathfinder.num_decrease_keys = counts
+        self.pathfinder.timings.add(timings)
+        return value
+
+    def close(self, release):
+        '''Stop using the status block once the worker is done with it, and
+        call release to free the job's resources'''
+        with self.lock:
+            self.closed = True
+        release()
+
+def attach_grid(name, shape, dtype):
+    '''Attach to a grid in shared memory, leaving it to the process that made
+    it to unlink it'''
+    # before python 3.13 attaching also registers the block, but with the
+    # resource tracker shared with the parent, which unregisters it on unlink
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype, buffer=block.buf)
+
+def run_search(method, pathfinder : PathFinder, args, kwargs, grids,
+        status_grid, snapshot_interval, deadline):
+    '''Run a search in a worker process, stopping it when it is cancelled or
+    at the deadline (a time.time() value), and return what it returned along
+    with the counts and timings'''
+    (elev_block, elev2d), (land_block, is_land) = [attach_grid(*grid)
+            for grid in grids]
+    status_block, status = attach_grid(*status_grid)
+    reached = status[2:]
+    last_snapshot = [time.time()]
+    def progress(times):
+        now = time.time()
+        if now > deadline:
+            raise SearchTimeout()
+        if status[0]:
+            raise SearchCancelled()
+        if snapshot_interval and len(times) == len(reached) and \
+                now - last_snapshot[0] >= snapshot_interval:
+            last_snapshot[0] = now
+            np.isfinite(times, out=reached)
+            status[1] = True
+    pathfinder.progress = progress
+
+    try:
+        progress(())
+        value = getattr(pathfinder, method)(*args, elev2d=elev2d,
+                map_server=None, is_land=is_land, **kwargs)
+    finally:
+        # the blocks can't close while viewed
+        del elev2d, is_land, status, reached
+        pathfinder.progress = None
+        elev_block.close()
+        land_block.close()
+        status_block.close()
+    return (value, (pathfinder.num_visited, pathfinder.num_pushes,
+        pathfinder.num_decrease_keys), pathfinder.timings.timings)
@@ -9,6 +9,11 @@ let mesh, texture;
 
 let helper;
 
+// the terrain grid being drawn, and the overlay of travel times or of the
+// grid points reached by a search in progress
+let grid, overlay;
+const vertical_scale = 10.0;
+
 const raycaster = new THREE.Raycaster();
 const pointer = new THREE.Vector2();
 
@@ -20,7 +25,7 @@ init(nx0, ny0, 1000, 1000, elev0, 1.0, 1.0, 0.0, 0.0);
 animate();
 
 function init(nx, ny, long_dist, lat_dist, elev, tex_scale_x, tex_scale_y,
-              tex_shift_x, tex_shift_y, image_url, path) {
+              tex_shift_x, tex_shift_y, image_url, path, times) {
   container = document.getElementById('terrain_container');
   container.innerHTML = '';
 
@@ -33,6 +38,7 @@ function init(nx, ny, long_dist, lat_dist, elev, tex_scale_x, tex_scale_y,
 
   scene = new THREE.Scene();
   scene.background = new THREE.Color(0xffffff);
+  overlay = undefined;
 
   camera = new THREE.PerspectiveCamera(60, window.innerWidth / window.innerHeight, 100, 200000);
  
@@ -56,7 +62,6 @@ function init(nx, ny, long_dist, lat_dist, elev, tex_scale_x, tex_scale_y,
   const geometry = new THREE.PlaneGeometry(long_dist, lat_dist, nx-1, ny-1);
   geometry.rotateX(-Math.PI / 2);
 
-  const vertical_scale = 10.0;
   const vertices = geometry.attributes.position.array;
   for (let i = 0, j = 0, l = vertices.length; i < l; i ++, j += 3) {
     vertices[j + 1] = vertical_scale * elev[i];
@@ -76,21 +81,12 @@ function init(nx, ny, long_dist, lat_dist, elev, tex_scale_x, tex_scale_y,
   mesh.receiveShadow = true;
   scene.add(mesh);
 
-  // draw the optimal path
-  let points = [];
-  for (let n = 0; n < path.length/2; n++) {
-    let i = path[2*n];
-    let j = path[2*n+1];
-    points.push(new THREE.Vector3(((i+0.5)/nx-0.5) * long_dist,
-      1.1*vertical_scale*elev[nx*j + i],
-      ((j+0.5)/ny-0.5) * lat_dist));
+  grid = {nx: nx, ny: ny, long_dist: long_dist, lat_dist: lat_dist,
+    elev: elev, geometry: geometry};
+  if (typeof times != 'undefined') {
+    set_overlay(times);
   }
-  const tube_curve = new THREE.CatmullRomCurve3(points);
-  const tube_thick = Math.sqrt(lat_dist*lat_dist + long_dist*long_dist)/300.0;
-  const tube_geometry = new THREE.TubeGeometry(tube_curve, nx+ny, tube_thick, 10, false);
-  const material = new THREE.MeshPhongMaterial({color: 0xff0000});
-  const tube_mesh = new THREE.Mesh(tube_geometry, material);
-  scene.add(tube_mesh);
+  add_path(path);
 
   // create a directional light and turn on shadows
   const light = new THREE.DirectionalLight(0xffffff, 1.0, 100);
@@ -118,6 +114,66 @@ function init(nx, ny, long_dist, lat_dist, elev, tex_scale_x, tex_scale_y,
   window.addEventListener('resize', onWindowResize);
 }
 
+// colour the terrain by travel time, as a fraction of the time limit, from
+// green at the start to red at the limit, leaving out points that can't be
+// reached in time
+function set_overlay(times) {
+  const nx = grid.nx, ny = grid.ny;
+  if (typeof overlay != 'undefined') {
+    scene.remove(overlay);
+    overlay.geometry.dispose();
+  }
+  const colors = new Float32Array(3*nx*ny);
+  const index = [];
+  const color = new THREE.Color();
+  for (let k = 0; k < nx*ny; k++) {
+    color.setHSL(0.33*(1.0 - Math.min(times[k], 1.0)), 1.0, 0.5);
+    color.toArray(colors, 3*k);
+  }
+  for (let j = 0; j < ny-1; j++) {
+    for (let i = 0; i < nx-1; i++) {
+      const a = nx*j + i, b = a + 1, c = a + nx, d = c + 1;
+      if (isFinite(times[a]) && isFinite(times[b]) && isFinite(times[c])) {
+        index.push(a, c, b);
+      }
+      if (isFinite(times[b]) && isFinite(times[c]) && isFinite(times[d])) {
+        index.push(c, d, b);
+      }
+    }
+  }
+  const time_geometry = grid.geometry.clone();
+  time_geometry.setIndex(index);
+  time_geometry.setAttribute('color', new THREE.BufferAttribute(colors, 3));
+  const time_material = new THREE.MeshBasicMaterial({vertexColors: true,
+    transparent: true, opacity: 0.5, depthWrite: false});
+  overlay = new THREE.Mesh(time_geometry, time_material);
+  scene.add(overlay);
+}
+
+// draw the optimal path, if there is one
+function add_path(path) {
+  if (path.length == 0) {
+    return;
+  }
+  const nx = grid.nx, ny = grid.ny;
+  const long_dist = grid.long_dist, lat_dist = grid.lat_dist;
+  let points = [];
+  for (let n = 0; n < path.length/2; n++) {
+    let i = path[2*n];
+    let j = path[2*n+1];
+    // paths refined on finer grids have fractional indices
+    points.push(new THREE.Vector3(((i+0.5)/nx-0.5) * long_dist,
+      1.1*vertical_scale*grid.elev[nx*Math.round(j) + Math.round(i)],
+      ((j+0.5)/ny-0.5) * lat_dist));
+  }
+  const tube_curve = new THREE.CatmullRomCurve3(points);
+  const tube_thick = Math.sqrt(lat_dist*lat_dist + long_dist*long_dist)/300.0;
+  const tube_geometry = new THREE.TubeGeometry(tube_curve, nx+ny, tube_thick, 10, false);
+  const material = new THREE.MeshPhongMaterial({color: 0xff0000});
+  const tube_mesh = new THREE.Mesh(tube_geometry, material);
+  scene.add(tube_mesh);
+}
+
 function onWindowResize() {
   camera.aspect = window.innerWidth / window.innerHeight;
   camera.updateProjectionMatrix();
@@ -151,20 +207,101 @@ function onPointerMove(event) {
   }
 }
 
-// function to update terrain and texture data
-export function update(response) {
-  if (response.result == 2) {
+function alert_result(result) {
+  if (result == 2) {
     alert("Invalid Starting Location");
   }
-  else if (response.result == 3) {
+  else if (result == 3) {
     alert("Invalid Ending Location");
   }
-  else if (response.result == 4) {
+  else if (result == 4) {
     alert("No Valid Path Between Start and End");
   }
+}
+
+// function to update terrain and texture data
+export function update(response) {
+  alert_result(response.result);
   init(response.nx, response.ny, response.long_dist, response.lat_dist, 
     response.elev, response.tex_scale_x, response.tex_scale_y, 
     response.tex_shift_x, response.tex_shift_y, response.image_url, 
-    response.path);
+    response.path, response.times);
+}
+
+// function to update terrain and texture data with a travel time field,
+// decoding the times (see encode_times in payload.py) as fractions of the
+// time limit
+export function update_isochrone(response) {
+  if (response.result == 2) {
+    alert("Invalid Starting Location");
+    return;
+  }
+  const bytes = Uint8Array.from(atob(response.times), c => c.charCodeAt(0));
+  const steps = new Uint16Array(bytes.buffer);
+  const times = new Float32Array(steps.length);
+  for (let k = 0; k < steps.length; k++) {
+    times[k] = steps[k] == 65535 ? Infinity :
+      steps[k]*response.time_scale/response.max_time;
+  }
+  response.times = times;
+  response.path = [];
+  update(response);
+}
+
+
+// function to decode a binary route result (see payload.py) and then update
+// terrain and texture data
+export function update_binary(buffer) {
+  update(decode_binary(buffer));
+}
+
+function decode_binary(buffer) {
+  const header_length = new DataView(buffer).getUint32(0, true);
+  const response = JSON.parse(new TextDecoder().decode(
+    new Uint8Array(buffer, 4, header_length)));
+  const nx = response.nx, ny = response.ny;
+
+  // undo the delta encoding along each row, wrapping like int16
+  const elev_start = 4 + header_length;
+  const deltas = new Int16Array(buffer, elev_start, nx*ny);
+  const q = new Int16Array(1);
+  const elev = new Float32Array(nx*ny);
+  for (let j = 0; j < ny; j++) {
+    q[0] = 0;
+    for (let i = 0; i < nx; i++) {
+      q[0] += deltas[nx*j + i];
+      elev[nx*j + i] = response.elev_offset + response.elev_scale*q[0];
+    }
+  }
+  response.elev = elev;
+
+  const path_start = elev_start + 4*Math.ceil(nx*ny/2);
+  response.path = new Float32Array(buffer, path_start, response.path_length);
+  return response;
+}
+
+// functions to follow a streamed route result (see calculate_result_stream in
+// app.py): the terrain, packed like a binary result, then the grid points 
+// reached by the search so far, then the path
+export function update_terrain(terrain) {
+  const bytes = Uint8Array.from(atob(terrain.payload), c => c.charCodeAt(0));
+  update(decode_binary(bytes.buffer));
+}
+
+export function update_frontier(frontier) {
+  const bytes = Uint8Array.from(atob(frontier.reached), c => c.charCodeAt(0));
+  const times = new Float32Array(grid.nx*grid.ny);
+  for (let k = 0; k < times.length; k++) {
+    times[k] = (bytes[k >> 3] >> (7 - (k & 7))) & 1 ? 0.5 : Infinity;
+  }
+  set_overlay(times);
 }
 
+export function update_path(result) {
+  alert_result(result.result);
+  if (typeof overlay != 'undefined') {
+    scene.remove(overlay);
+    overlay = undefined;
+  }
+  add_path(result.path);
+}
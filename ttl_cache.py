@@ -0,0 +1,44 @@
+import threading, time
+from collections import OrderedDict
+
+class TTLCache:
+    '''Thread-safe in-memory cache whose entries expire ttl seconds after they
+    are added, and which evicts the least recently used entries once it holds
+    more than max_entries'''
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiry time, value)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''Get the value for a key, or None if it isn't cached or has expired'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def values(self):
+        '''Get a list of the values that haven't expired, least recently used
+        first'''
+        with self.lock:
+            now = time.monotonic()
+            return [value for expiry, value in self.entries.values() 
+                    if expiry >= now]
+
+    def put(self, key, value):
+        '''Add a value to the cache, evicting old entries if it is too big'''
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)